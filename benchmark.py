@@ -0,0 +1,231 @@
+"""
+Copyright (c) 2013 by Tomer Altman <tomer.altman@gmail.com>
+
+This file is part of MOSC.
+
+MOSC is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+MOSC is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with MOSC.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import sys
+import json
+import math
+import time
+import random
+import threading
+import argparse
+import platform
+import StringIO
+
+import yaml
+
+import pysc
+import interface
+import midiinterface
+import mosc
+import curves
+
+
+class NullInterface(interface.Interface):
+    def __init__(self):
+        super(NullInterface, self).__init__()
+        self.sent = 0
+
+    def send(self, address, *value):
+        self.sent += 1
+
+    def _run(self):
+        pass
+
+
+def measure(func, operations, repeat=5):
+    """Returns the best rate of operations per second out of repeat runs of func."""
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return operations / max(best, 1e-9)
+
+
+def codec_benchmarks(count):
+    shapes = {"float": pysc.Message("/1/fader1", 0.5),
+              "xy": pysc.Message("/5/xy1", 0.25, 0.75),
+              "bundle": pysc.Bundle(pysc.Time(-1), *[pysc.Message("/1/multifader1/%d" % i, i / 64.0) for i in xrange(64)]),
+              "blob": pysc.Message("/blob", pysc.Blob("\x55" * 1024))}
+    results = {}
+    for name, message in sorted(shapes.iteritems()):
+        packet = pysc.serialize(message)
+
+        def serialize():
+            for _ in xrange(count):
+                pysc.serialize(message)
+
+        def deserialize():
+            for _ in xrange(count):
+                pysc.deserialize(packet)
+
+        results["serialize.%s" % name] = measure(serialize, count)
+        results["deserialize.%s" % name] = measure(deserialize, count)
+    return results
+
+
+def transform_benchmarks(count):
+    transform = midiinterface.MidiTransformer().transform
+    events = []
+    for i in xrange(count // 4):
+        nrpn, value = i % 1024, (i * 7) % 16384
+        events.extend([(i % 16, 0xB, 99, nrpn >> 7), (i % 16, 0xB, 98, nrpn & 0x7F),
+                       (i % 16, 0xB, 6, value >> 7), (i % 16, 0xB, 38, value & 0x7F)])
+
+    def run():
+        for event in events:
+            transform(*event)
+
+    # A bank dump of every value of a 14 bits route, converted at once
+    transformer = mosc.value_transformer((0, 16383), (0.0, 1.0), float, float, "log", True, 16384)
+    dump = [i % 16384 for i in xrange(count)]
+
+    return {"transform.nrpn": measure(run, len(events)),
+            "transform.many": measure(lambda: curves.transform_many(transformer, dump), count)}
+
+
+def make_map(routes):
+    mapping = [["/bench/%d" % i, [i % 16384, "nrpn", 0, 16383, (i // 16384) % 16]] for i in xrange(routes)]
+    return yaml.dump({"interfaces": {"osc": [0], "midi": ["in", "out"]}, "mapping": mapping})
+
+
+def routing_benchmarks(count, sizes):
+    results = {}
+    rand = random.Random(0)
+    for routes in sizes:
+        osc, midi = NullInterface(), NullInterface()
+        mosc.ValueMapperApp(StringIO.StringIO(make_map(routes)), interfaces={"osc": osc, "midi": midi})
+        osc_messages = [("/bench/%d" % rand.randrange(routes), rand.random()) for _ in xrange(count)]
+        midi_messages = [((0, "nrpn", rand.randrange(min(routes, 16384))), rand.randrange(16384)) for _ in xrange(count)]
+
+        def osc_to_midi():
+            for address, value in osc_messages:
+                osc.handler(address, value)
+
+        def midi_to_osc():
+            for address, value in midi_messages:
+                midi.handler(address, value)
+
+        results["routing.osc_to_midi.%d" % routes] = measure(osc_to_midi, count)
+        results["routing.midi_to_osc.%d" % routes] = measure(midi_to_osc, count)
+    return results
+
+
+def output_jitter(count, latency, period=0.005):
+    """
+    Writes count Midi events meant for every period seconds while another thread keeps the interpreter busy.
+    Returns the standard deviation of the measured times of the writes from the intended times, in milliseconds,
+    and for timed output the fraction of events written soon enough for their timestamp to be honoured.
+    Untimed events are played when written, timed ones at their timestamp plus the latency if written before then.
+    """
+    name = "jitter %d" % latency
+    midi = midiinterface.MidiInterface(name, name, backend="loopback", latency=latency)
+    device, backend = midi.out_device, midi.backend
+    write, write_short = device.write, device.write_short
+    writes = []
+
+    def timed_write(events):
+        writes.append((time.time(), backend.time(), events[0][1]))
+        write(events)
+
+    def untimed_write(*data):
+        writes.append((time.time(), backend.time(), None))
+        write_short(*data)
+
+    device.write, device.write_short = timed_write, untimed_write
+    busy = [True]
+
+    def load():
+        message = pysc.Message("/1/fader1", 0.5)
+        while busy[0]:
+            pysc.deserialize(pysc.serialize(message))
+
+    thread = threading.Thread(target=load)
+    thread.start()
+    start = time.time() + 0.01
+    targets = [start + i * period for i in xrange(count)]
+    for i, target in enumerate(targets):
+        time.sleep(max(target - time.time(), 0))
+        interface.context.received = target
+        midi.send((0, "cc", 1), i % 128)
+    busy[0] = False
+    thread.join()
+    interface.context.received = None
+
+    errors = [(written - target) * 1000 for target, (written, now, stamp) in zip(targets, writes)]
+    mean = sum(errors) / len(errors)
+    jitter = math.sqrt(sum((error - mean) ** 2 for error in errors) / len(errors))
+    if not latency:
+        return jitter, None
+    return jitter, sum(1 for written, now, stamp in writes if now <= stamp + latency) / float(len(writes))
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline["results"]:
+            print "%-40s %14.0f/s" % (name, results[name])
+            continue
+        ratio = results[name] / baseline["results"][name]
+        print "%-40s %14.0f/s %7.2fx" % (name, results[name], ratio)
+        if ratio < 1.0 - tolerance:
+            regressions.append(name)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks of the OSC codec, Midi decoding and routing")
+    parser.add_argument("-n", "--count", type=int, default=20000, help="Operations per measurement")
+    parser.add_argument("--routes", type=int, nargs="+", default=[10, 1000, 10000], help="Map sizes for the routing benchmarks")
+    parser.add_argument("-o", "--output", help="Write the results as JSON to this file")
+    parser.add_argument("-b", "--baseline", help="Compare with the results in this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Slowdown from the baseline reported as a regression")
+    parser.add_argument("--jitter", type=int, nargs="+", metavar="LATENCY",
+                        help="Only measure the Midi output jitter with these latencies (in milliseconds, 0 for untimed output)")
+    args = parser.parse_args()
+
+    if args.jitter:
+        for latency in args.jitter:
+            jitter, on_time = output_jitter(min(args.count, 1000), latency)
+            if on_time is None:
+                print "latency %3d ms: write jitter %.3f ms, played when written" % (latency, jitter)
+            else:
+                print "latency %3d ms: write jitter %.3f ms, %.1f%% written in time for their timestamp" % (
+                    latency, jitter, on_time * 100)
+        sys.exit(0)
+
+    results = {}
+    results.update(codec_benchmarks(args.count))
+    results.update(transform_benchmarks(args.count))
+    results.update(routing_benchmarks(args.count, args.routes))
+    report = {"python": platform.python_version(), "platform": platform.platform(), "count": args.count, "results": results}
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+
+    if args.baseline:
+        regressions = compare(results, json.load(open(args.baseline)), args.tolerance)
+        if regressions:
+            print "Regressions: %s" % ", ".join(regressions)
+            sys.exit(1)
+    else:
+        json.dump(report, sys.stdout, indent=1, sort_keys=True)
+        print
@@ -17,42 +17,54 @@ You should have received a copy of the GNU General Public License
 along with MOSC.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import xml.etree.ElementTree as ET
 import StringIO
+import tempfile
+from xml.sax.saxutils import escape
+
+HEADER = "<?xml version='1.0' encoding='UTF-8'?>\n"
+
+
+def _element(tag, text):
+    text = escape(str(text))
+    return "<%s>%s</%s>" % (tag, text, tag) if text else "<%s />" % tag
+
+
+def _attribute(value):
+    return '"%s"' % escape(value, {'"': "&quot;", "\n": "&#10;"})
+
 
 class CubaseMapper(object):
+    """
+    Writes a Generic Remote description while mappings are added, with bounded memory:
+    controls go straight to the output, and bank entries to a temporary file copied after them by close().
+    Mappings of the same Midi message share a single control.
+    """
     PUSH     = 0b0000000001
     TOGGLE   = 0b0110000000
     NO_AUTO  = 0b1000000000
 
-    def __init__(self):
-        self.root = ET.Element("remotedescription", version="1.1")
-        self.ctrltable = ET.SubElement(self.root, "ctrltable", name="Standard MIDI")
-        self.ctrltable.text = self.ctrltable.tail = "\n"
-        self.bank = ET.SubElement(self.root, "bank", name="1")
-        self.bank.text = self.bank.tail = "\n"
+    def __init__(self, output=None):
+        self.output = StringIO.StringIO() if output is None else output
+        self.bank = tempfile.SpooledTemporaryFile(1 << 20)
+        self.ctrls = {}
         self.name_index = 0
+        self.output.write(HEADER + '<remotedescription version="1.1"><ctrltable name="Standard MIDI">\n')
 
     def add_mapping(self, address, name, flags=0, relative=False, echo=False):
         entryname = self._addctrl(address, relative, echo)
-        entry = self._addentry(entryname)
         parts = name.split(";")
         if len(parts) == 2:
             category, action = parts
-            self._addcommand(entry, category, action)
+            entry = self._command(category, action)
         elif len(parts) == 3:
             device, channel, name = parts
-            self._addvalue(entry, device, channel, name, flags)
+            entry = self._value(device, channel, name, flags)
         else:
             raise Exception("wtf %s" % (parts,))
+        self.bank.write("<entry ctrl=%s>%s</entry>\n" % (_attribute(entryname), entry))
 
-    def _addentry(self, entryname):
-        entry = ET.SubElement(self.bank, "entry", ctrl=entryname)
-        entry.tail = "\n"
-        return entry
-
-    STATS = {"noteon": "144", "cc": "176", "nrpn": "2"}
-    MAXES = {"noteon": "127", "cc": "127", "nrpn": "16383"}
+    STATS = {"noteon": "144", "cc": "176", "pitchbend": "224", "nrpn": "2"}
+    MAXES = {"noteon": "127", "cc": "127", "pitchbend": "16383", "nrpn": "16383"}
     RECEIVE  = 0b000000001
     TRANSMIT = 0b000000010
     RELATIVE = 0b000000100
@@ -60,47 +72,53 @@ class CubaseMapper(object):
     NRPN     = 0b000010000
     ECHO     = 0b000100000
     def _addctrl(self, address, relative, echo):
-        ctrl = ET.SubElement(self.ctrltable, "ctrl")
-        ctrl.tail = "\n"
-        
-        name = "Ctrl %d" % self.name_index
-        self.name_index += 1
-
         type, channel, code = address
-        ET.SubElement(ctrl, "name").text = name
-        ET.SubElement(ctrl, "stat").text = self.STATS[type]
-        ET.SubElement(ctrl, "chan").text = str(channel)
-        ET.SubElement(ctrl, "addr").text = str(code)
-        ET.SubElement(ctrl, "max").text = self.MAXES[type]
-        
         flags = self.RECEIVE
         if type == "nrpn":
             flags |= self.NRPN
         flags |= self.RELATIVE if relative else self.TRANSMIT
         if echo:
             flags |= self.ECHO
-        ET.SubElement(ctrl, "flags").text = str(flags)
 
+        key = self.STATS[type], channel, code, flags
+        name = self.ctrls.get(key)
+        if name is not None:
+            return name
+
+        name = self.ctrls[key] = "Ctrl %d" % self.name_index
+        self.name_index += 1
+        self.output.write("<ctrl>%s%s%s%s%s%s</ctrl>\n" % (_element("name", name),
+                                                            _element("stat", self.STATS[type]),
+                                                            _element("chan", channel),
+                                                            _element("addr", code),
+                                                            _element("max", self.MAXES[type]),
+                                                            _element("flags", flags)))
         return name
 
-    def _addcommand(self, entry, category, action):
-        command = ET.SubElement(entry, "command")
-        ET.SubElement(command, "category").text = category
-        ET.SubElement(command, "action").text = action
-        ET.SubElement(command, "flags").text = str(self.PUSH)
+    def _command(self, category, action):
+        return "<command>%s%s%s</command>" % (_element("category", category),
+                                              _element("action", action),
+                                              _element("flags", self.PUSH))
 
-    def _addvalue(self, entry, device, channel, name, flags):
-        value = ET.SubElement(entry, "value")
-        ET.SubElement(value, "device").text = device
+    def _value(self, device, channel, name, flags):
         if channel.lower() == "selected":
             channel = -2
         elif channel.lower() == "device":
             channel = -1
-        ET.SubElement(value, "chan").text = str(channel)
-        ET.SubElement(value, ("tag" if name.isdigit() else "name")).text = name
-        ET.SubElement(value, "flags").text = str(flags)
+        return "<value>%s%s%s%s</value>" % (_element("device", device),
+                                            _element("chan", channel),
+                                            _element("tag" if name.isdigit() else "name", name),
+                                            _element("flags", flags))
+
+    def close(self):
+        self.output.write('</ctrltable>\n<bank name="1">\n')
+        self.bank.seek(0)
+        for block in iter(lambda: self.bank.read(1 << 16), ""):
+            self.output.write(block)
+        self.bank.close()
+        self.output.write("</bank>\n</remotedescription>")
 
     def dump(self):
-        s = StringIO.StringIO()
-        ET.ElementTree(self.root).write(s, "UTF-8")
-        return s.getvalue()
+        # Only for mappers writing to memory, the default
+        self.close()
+        return self.output.getvalue()
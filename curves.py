@@ -0,0 +1,161 @@
+"""
+Copyright (c) 2013 by Tomer Altman <tomer.altman@gmail.com>
+
+This file is part of MOSC.
+
+MOSC is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+MOSC is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with MOSC.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import math
+import array
+import bisect
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+"""
+Response curves map the normalized OSC position (0.0-1.0) to the normalized Midi value (0.0-1.0).
+The Midi to OSC direction uses the inverse curve. Curves are given in routes' options as:
+  curve: log           # Fine control at the bottom of the range
+  curve: exp           # Fine control at the top of the range
+  curve: [0, 0.5, 1]   # A table of Midi values for evenly spaced OSC positions, interpolated linearly.
+                       # The table must be increasing for the Midi to OSC direction.
+"""
+
+
+def _log(position):
+    return math.log10(1.0 + 9.0 * position)
+
+
+def _exp(position):
+    return (10.0 ** position - 1.0) / 9.0
+
+
+def _table(points):
+    last = len(points) - 1
+
+    def curve(position):
+        position = min(max(position, 0.0), 1.0) * last
+        index = min(int(position), last - 1)
+        return points[index] + (points[index + 1] - points[index]) * (position - index)
+    return curve
+
+
+def _inverse_table(points):
+    last = len(points) - 1
+
+    def curve(value):
+        value = min(max(value, points[0]), points[-1])
+        index = min(max(bisect.bisect_right(points, value) - 1, 0), last - 1)
+        span = points[index + 1] - points[index]
+        return (index + ((value - points[index]) / span if span else 0.0)) / last
+    return curve
+
+
+def get_curve(curve):
+    """Returns the (curve, inverse curve) functions for a curve given in a map."""
+    if curve is None or curve == "linear":
+        return None, None
+    if curve == "log":
+        return _log, _exp
+    if curve == "exp":
+        return _exp, _log
+    if isinstance(curve, (list, tuple)) and len(curve) >= 2:
+        points = [float(point) for point in curve]
+        if any(b < a for a, b in zip(points, points[1:])):
+            raise Exception("Curve table %s must be increasing, to be inverted for the Midi to OSC direction" % (curve, ))
+        return _table(points), _inverse_table(points)
+    raise Exception("Unknown curve %s" % (curve, ))
+
+
+def curve_key(curve):
+    return tuple(curve) if isinstance(curve, list) else curve
+
+
+_tables = {}
+
+
+def lookup_table(key, size, function, typecode="d"):
+    """Table of function(0) to function(size - 1), shared by all the routes with the same key."""
+    table = _tables.get((key, size, typecode))
+    if table is None:
+        table = _tables[key, size, typecode] = array.array(typecode, (function(value) for value in xrange(size)))
+    return table
+
+
+def lookup(table, compute):
+    """Transformer reading the value from the table, or computing it for values outside the table."""
+    size = len(table)
+
+    def transform(value):
+        # Midi values are ints, anything else (floats, out of range values) is computed
+        if value.__class__ is int and 0 <= value < size:
+            return table[value]
+        return compute(value)
+    transform.table = table
+    transform.compute = compute
+    return transform
+
+
+def transform_many(transformer, values):
+    """
+    Transforms many values at once, such as the values of a bank dump or of a snapshot.
+    An integer numpy array within the transformer's table is transformed with a single vectorized lookup.
+    """
+    table = getattr(transformer, "table", None)
+    if table is None:
+        return [transformer(value) for value in values]
+    size = len(table)
+    if numpy is not None and isinstance(values, numpy.ndarray):
+        if values.dtype.kind in "iu" and values.size and 0 <= values.min() and values.max() < size:
+            return numpy.frombuffer(table, dtype=table.typecode)[values]
+        values = values.tolist()
+    compute = transformer.compute
+    return [table[value] if value.__class__ is int and 0 <= value < size else compute(value) for value in values]
+
+
+def test():
+    log, exp = get_curve("log")
+    for position in (0.0, 0.25, 0.5, 1.0):
+        assert abs(exp(log(position)) - position) < 1e-9
+    points, inverse = get_curve([0, 0.2, 0.8, 1])
+    for position in (0.0, 0.1, 0.5, 0.99, 1.0):
+        assert abs(inverse(points(position)) - position) < 1e-9
+
+    compute = lambda value: value / 127.0
+    transform = lookup(lookup_table("test", 128, compute), compute)
+    for value in (0, 1, 64, 126, 127):
+        assert transform(value) == compute(value)
+    # Past either end of the table, and values that are not ints, are computed
+    for value in (-1, 128, 1000, 1.0, 2.5, -0.5):
+        assert transform(value) == compute(value)
+
+    values = [0, 1, 64, 127, -1, 128, 1.0, 2.5]
+    assert transform_many(transform, values) == [compute(value) for value in values]
+    assert transform_many(compute, values) == [compute(value) for value in values]
+    if numpy is not None:
+        assert list(transform_many(transform, numpy.arange(128))) == [compute(value) for value in xrange(128)]
+        assert transform_many(transform, numpy.array([-1, 5, 200])) == [compute(value) for value in (-1, 5, 200)]
+
+    try:
+        get_curve([0, 0.8, 0.2, 1])
+        assert False
+    except Exception as e:
+        assert "increasing" in str(e)
+
+
+if __name__ == "__main__":
+    test()
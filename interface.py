@@ -18,13 +18,29 @@ along with MOSC.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import abc
+import time
 import threading
+import traceback
+import collections
+
+# Information about the message being handled by the current thread.
+# Interfaces set context.received to the time the message was received before calling their handler,
+# and context.target to the time the message is meant for when it has one, such as the time tag of its OSC bundle.
+context = threading.local()
+
 
 class Interface(object):
     __metaclass__ = abc.ABCMeta
     
     def __init__(self):
         self.handler = None
+        self.queue = None
+
+    def queue_output(self, size=1024, deadline=None):
+        # From now on send only queues the message, the queue's thread is the only one writing to the interface
+        self.queue = OutputQueue(self.send, size, deadline)
+        self.send = self.queue.put
+        self.queue.start()
 
     def start(self):
         self.thread = threading.Thread(target=self._run)
@@ -38,3 +54,88 @@ class Interface(object):
     @abc.abstractmethod
     def _run(self):
         pass
+
+
+class OutputQueue(object):
+    """
+    Bounded queue of the messages to send through an interface, written in order by a single thread.
+    When the queue is full, a message replaces the one waiting for the same address, or pushes out the oldest message.
+    Messages waiting for longer than deadline seconds are dropped instead of written.
+    A message failing to be written is reported and counted, and the writing goes on with the next one.
+    Putting a message never waits for the writer.
+    on_write, when set, is called after each write with the address, the time the message waited in the queue,
+    the time the write took and the time it ended.
+    """
+    def __init__(self, write, size=1024, deadline=None):
+        self.write = write
+        self.on_write = None
+        self.size = size
+        self.deadline = deadline
+        self.entries = collections.deque()
+        # The last entry waiting for each address, each entry being [address, value, queued time, context]
+        self.last = {}
+        self.condition = threading.Condition(threading.Lock())
+        self.queued = 0
+        self.written = 0
+        self.coalesced = 0
+        self.overflowed = 0
+        self.stale = 0
+        self.failed = 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, address, *value):
+        now = time.time()
+        with self.condition:
+            self.queued += 1
+            if len(self.entries) >= self.size:
+                entry = self.last.get(address)
+                if entry is not None:
+                    entry[1:] = value, now, self._context()
+                    self.coalesced += 1
+                    return
+                self._forget(self.entries.popleft())
+                self.overflowed += 1
+            entry = [address, value, now, self._context()]
+            self.entries.append(entry)
+            self.last[address] = entry
+            self.condition.notify()
+
+    @staticmethod
+    def _context():
+        return getattr(context, "received", None), getattr(context, "target", None)
+
+    def _forget(self, entry):
+        if self.last.get(entry[0]) is entry:
+            del self.last[entry[0]]
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.entries:
+                    self.condition.wait()
+                entry = self.entries.popleft()
+                self._forget(entry)
+            address, value, queued, (received, target) = entry
+            start = time.time()
+            if self.deadline is not None and start - queued > self.deadline:
+                self.stale += 1
+                continue
+            context.received, context.target = received, target
+            try:
+                self.write(address, *value)
+            except Exception:
+                traceback.print_exc()
+                self.failed += 1
+                continue
+            self.written += 1
+            if self.on_write is not None:
+                end = time.time()
+                self.on_write(address, start - queued, end - start, end)
+
+    def stats(self):
+        return {"queued": self.queued, "written": self.written, "waiting": len(self.entries),
+                "coalesced": self.coalesced, "overflowed": self.overflowed, "stale": self.stale, "failed": self.failed}
@@ -0,0 +1,107 @@
+"""
+Copyright (c) 2013 by Tomer Altman <tomer.altman@gmail.com>
+
+This file is part of MOSC.
+
+MOSC is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+MOSC is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with MOSC.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import os
+import json
+import marshal
+import hashlib
+import yaml
+
+import ratelimit
+
+# The libyaml parser is much faster on large maps, when PyYAML was built with it
+Loader = getattr(yaml, "CLoader", yaml.Loader)
+
+# Bumped whenever the compiled table's layout changes, invalidating older caches
+VERSION = 3
+SUFFIX = ".cache"
+
+
+def parse(stream):
+    return yaml.load(stream, Loader=Loader)
+
+
+def compile_part(part):
+    return tuple(part) if isinstance(part, list) else (part,)
+
+
+def compile_map(data):
+    """
+    Normalizes a parsed map into a routing table made of plain values only, so it can be marshalled.
+    Each mapping line becomes (key, osc arguments, midi arguments, direction, options), keyed by its
+    normalized text so reloads can tell which lines changed.
+    """
+    rate_limit = data.get("rate_limit", {})
+    unknown = set(rate_limit) - set(("osc", "midi"))
+    if unknown:
+        raise Exception("Unknown rate_limit interfaces %s, expected osc and midi" % ", ".join(sorted(map(str, unknown))))
+    for rate in rate_limit.itervalues():
+        ratelimit.interval(rate)
+    mapping = []
+    for mapparts in data["mapping"]:
+        direction = "="
+        options = {}
+        for extra in mapparts[2:]:
+            if isinstance(extra, dict):
+                options = extra
+            else:
+                direction = extra
+        if "rate_limit" in options:
+            ratelimit.interval(options["rate_limit"])
+        key = json.dumps(mapparts, sort_keys=True)
+        mapping.append((key, compile_part(mapparts[0]), compile_part(mapparts[1]), direction, options))
+    return {"interfaces": data["interfaces"],
+            "rate_limit": rate_limit,
+            "suppress": data.get("suppress", {}),
+            "output_queue": data.get("output_queue", {}),
+            "mapping": mapping}
+
+
+def load(path, cache=True):
+    """
+    Returns the compiled table of the map at path and whether it came from the cache.
+    The cache is kept next to the map, and only used when its content hash matches the map's.
+    """
+    with open(path, "rb") as f:
+        source = f.read()
+    digest = hashlib.sha1(source).hexdigest()
+    cache_path = path + SUFFIX
+    if cache:
+        try:
+            with open(cache_path, "rb") as f:
+                version, cached_digest, table = marshal.load(f)
+            if version == VERSION and cached_digest == digest:
+                return table, True
+        except (IOError, EOFError, ValueError, TypeError):
+            pass
+
+    table = compile_map(parse(source))
+    if cache:
+        temp = cache_path + ".tmp"
+        try:
+            with open(temp, "wb") as f:
+                marshal.dump((VERSION, digest, table), f)
+            if os.name == "nt" and os.path.exists(cache_path):
+                os.remove(cache_path)
+            os.rename(temp, cache_path)
+        except (IOError, OSError, ValueError):
+            # An unwritable directory or an unmarshallable value only cost the next start a parse
+            pass
+    return table, False
@@ -0,0 +1,174 @@
+"""
+Copyright (c) 2013 by Tomer Altman <tomer.altman@gmail.com>
+
+This file is part of MOSC.
+
+MOSC is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+MOSC is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with MOSC.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import time
+import random
+import threading
+import collections
+
+
+class PygameBackend(object):
+    """Midi devices through PortMidi, as bundled with pygame."""
+    def __init__(self):
+        import pygame.midi as pym
+        self.pym = pym
+        pym.init()
+
+    def open_input(self, name):
+        return self.pym.Input(self._getdevice(name, True))
+
+    def open_output(self, name, latency=0):
+        # With a latency (in milliseconds), PortMidi delivers each event at its timestamp plus the latency
+        return self.pym.Output(self._getdevice(name, False), latency)
+
+    def time(self):
+        return self.pym.time()
+
+    def _getdevice(self, name, is_input):
+        for i in xrange(self.pym.get_count()):
+            info = self.pym.get_device_info(i)
+            if info[1] != name:
+                continue
+            if is_input:
+                if info[2]:
+                    return i
+            else:
+                if info[3]:
+                    return i
+        raise Exception("Interface (%s, input=%s) was not found!" % (name, is_input))
+
+
+class LoopbackPort(object):
+    """Events written to the port by loopback outputs, readable by the loopback inputs of the same name."""
+    def __init__(self, name):
+        self.name = name
+        self.events = collections.deque()
+        self.condition = threading.Condition()
+        self.last_delivery = 0.0
+
+    def put(self, event, timestamp, delivery):
+        with self.condition:
+            # Jitter delays events but never reorders them
+            self.last_delivery = max(delivery, self.last_delivery)
+            self.events.append((self.last_delivery, event, timestamp))
+            self.condition.notify_all()
+
+
+class LoopbackInput(object):
+    def __init__(self, port):
+        self.port = port
+
+    def poll(self):
+        events = self.port.events
+        return bool(events) and events[0][0] <= time.time()
+
+    def read(self, num_events):
+        events = []
+        now = time.time()
+        with self.port.condition:
+            queue = self.port.events
+            while queue and len(events) < num_events and queue[0][0] <= now:
+                delivery, event, timestamp = queue.popleft()
+                events.append([event, timestamp])
+        return events
+
+    def wait(self, timeout):
+        end = time.time() + timeout
+        with self.port.condition:
+            while True:
+                now = time.time()
+                queue = self.port.events
+                if (queue and queue[0][0] <= now) or now >= end:
+                    return
+                self.port.condition.wait(min(queue[0][0], end) - now if queue else end - now)
+
+    def close(self):
+        pass
+
+
+class LoopbackOutput(object):
+    def __init__(self, port, backend, latency=0):
+        self.port = port
+        self.backend = backend
+        self.latency = latency
+
+    def write_short(self, status, data1=0, data2=0):
+        self.port.put([status, data1, data2, 0], self.backend.time(), self.backend.delivery())
+
+    def write(self, events):
+        timestamp, delivery = self.backend.time(), self.backend.delivery()
+        for event, event_timestamp in events:
+            if self.latency:
+                # Like PortMidi, timestamped events are delivered at their timestamp plus the latency
+                delivery = self.backend.delivery(event_timestamp + self.latency)
+            self.port.put((list(event) + [0, 0, 0])[:4], timestamp, delivery)
+
+    def note_on(self, note, velocity, channel=0):
+        self.write_short(0x90 | channel, note, velocity)
+
+    def note_off(self, note, velocity=0, channel=0):
+        self.write_short(0x80 | channel, note, velocity)
+
+    def close(self):
+        pass
+
+
+class LoopbackBackend(object):
+    """
+    In memory Midi ports for running without Midi devices. An output writes to the port of its name,
+    from which the inputs of the same name read, after latency plus a random jitter (in seconds).
+    Ports are shared by all the loopback backends of the process.
+    """
+    ports = {}
+    lock = threading.Lock()
+    epoch = time.time()
+
+    def __init__(self, latency=0.0, jitter=0.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.random = random.Random(seed)
+
+    @classmethod
+    def port(cls, name):
+        with cls.lock:
+            if name not in cls.ports:
+                cls.ports[name] = LoopbackPort(name)
+            return cls.ports[name]
+
+    def open_input(self, name):
+        return LoopbackInput(self.port(name))
+
+    def open_output(self, name, latency=0):
+        return LoopbackOutput(self.port(name), self, latency)
+
+    def time(self):
+        # Milliseconds, like PortMidi timestamps
+        return int((time.time() - self.epoch) * 1000)
+
+    def delivery(self, timestamp=None):
+        start = time.time() if timestamp is None else self.epoch + timestamp / 1000.0
+        return start + self.latency + self.random.uniform(0, self.jitter)
+
+
+BACKENDS = {"pygame": PygameBackend,
+            "loopback": LoopbackBackend}
+
+
+def create_backend(name, options=None):
+    return BACKENDS[name](**(options or {}))
@@ -18,8 +18,9 @@ along with MOSC.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import time
-import pygame.midi as pym
+import threading
 import interface
+import midibackend
 
 
 class NRPNTransformer(object):
@@ -53,6 +54,46 @@ class NRPNTransformer(object):
         return (self.cc6 << 7) + self.cc38
 
 
+class NRPNEncoder(object):
+    """
+    Encodes NRPN updates into lists of Midi events for Output.write.
+    The selected parameter and data MSB of each channel are kept, so that the parameter select CCs (99, 98)
+    are only sent when the parameter changes, and with lsb_only the data MSB (CC 6) only when it changes.
+    The kept state is only right if the encoded events are written in the order they were encoded,
+    and if the other writes to these controllers reset the state of their channel.
+    """
+    CONTROLLERS = frozenset((6, 38, 98, 99, 100, 101))
+
+    def __init__(self, lsb_only=False):
+        self.lsb_only = lsb_only
+        self.parameters = [None] * 16
+        self.msbs = [None] * 16
+        self.events = 0
+
+    def encode(self, channel, nrpn, data, timestamp=0):
+        status = 0xB0 | channel
+        events = []
+        if self.parameters[channel] != nrpn:
+            self.parameters[channel] = nrpn
+            self.msbs[channel] = None
+            events.append([[status, 99, nrpn >> 7], timestamp])
+            events.append([[status, 98, nrpn & 0x7F], timestamp])
+        msb = data >> 7
+        if not self.lsb_only or self.msbs[channel] != msb:
+            self.msbs[channel] = msb
+            events.append([[status, 6, msb], timestamp])
+        events.append([[status, 38, data & 0x7F], timestamp])
+        self.events += len(events)
+        return events
+
+    def reset(self, channel):
+        self.parameters[channel] = self.msbs[channel] = None
+
+    @property
+    def bytes(self):
+        return self.events * 3
+
+
 class MidiTransformer(object):
     def __init__(self):
         self.nrpns = [NRPNTransformer() for _ in xrange(16)]
@@ -67,59 +108,158 @@ class MidiTransformer(object):
             if nrpntrans.modify(data1, data2):
                 return (channel, "nrpn", nrpntrans.nrpn), nrpntrans.value
             return (channel, "cc", data1), data2
+        if code == 0xE:
+            return (channel, "pitchbend", 0), (data2 << 7) + data1
         raise Exception("Unknown code %s" % code)
 
 
 class MidiInterface(interface.Interface):
-    def __init__(self, in_name, out_name, sleep_time=0.005):
+    def __init__(self, in_name, out_name, sleep_time=0.005, min_sleep_time=0.0005, adaptive=True, read_size=64,
+                 nrpn_lsb_only=False, backend="pygame", backend_options=None, latency=0):
         super(MidiInterface, self).__init__()
-        pym.init()
-        self.in_device = self._getdevice(in_name, True)
-        self.out_device = self._getdevice(out_name, False)
-        self.last_nrpn = None
+        self.backend = midibackend.create_backend(backend, backend_options)
+        self.in_device = self.backend.open_input(in_name)
+        # With a latency (in milliseconds), events are timestamped with the time their message is meant for
+        self.latency = latency
+        self.out_device = self.backend.open_output(out_name, latency)
+        self.last_stamp = 0
+        self.output_events = 0
+        self.output_lateness_total = 0
+        self.output_late = 0
+        self.encoder = NRPNEncoder(nrpn_lsb_only)
+        # Encoding and writing NRPNs is atomic, as the encoder relies on the parameter selected last on the output
+        self.nrpn_lock = threading.Lock()
         self.transformer = MidiTransformer().transform
         self.sleep_time = sleep_time
+        self.min_sleep_time = min_sleep_time if adaptive else sleep_time
+        self.read_size = read_size
+        self.input_events = 0
+        self.input_latency_total = 0
+        self.input_latency_max = 0
 
     def _run(self):
+        # Polling starts at min_sleep_time after activity and backs off up to sleep_time when idle
+        sleep_time = self.min_sleep_time
+        wait = getattr(self.in_device, "wait", None)
         while True:
-            while not self.in_device.poll() or self.handler is None:
+            if self.handler is None:
                 time.sleep(self.sleep_time)
-            for event, timestamp in self.in_device.read(10):
+            elif self.in_device.poll():
+                self._drain()
+                sleep_time = self.min_sleep_time
+            elif wait is not None:
+                wait(self.sleep_time)
+            else:
+                time.sleep(sleep_time)
+                sleep_time = min(sleep_time * 2, self.sleep_time)
+
+    def _drain(self):
+        while self.in_device.poll():
+            events = self.in_device.read(self.read_size)
+            now = self.backend.time()
+            wall_now = time.time()
+            for event, timestamp in events:
                 status, data1, data2, data3 = event
+                latency = now - timestamp
+                interface.context.received = wall_now - latency / 1000.0
                 self.handler(*self.transformer(status & 0xF, status >> 4, data1, data2))
+                self.input_events += 1
+                self.input_latency_total += latency
+                self.input_latency_max = max(self.input_latency_max, latency)
+
+    def input_stats(self):
+        # Latencies are in milliseconds, from the timestamp of the event to its handling
+        return {"events": self.input_events,
+                "mean_latency": float(self.input_latency_total) / self.input_events if self.input_events else 0.0,
+                "max_latency": self.input_latency_max}
 
     def send(self, address, value):
         channel, command, code = address
         getattr(self, command)(channel, code, value)
 
+    def output_stats(self):
+        # Lateness is in milliseconds, from the time the event was meant for until it was written.
+        # Events later than the latency are delivered late.
+        return {"events": self.output_events,
+                "mean_lateness": float(self.output_lateness_total) / self.output_events if self.output_events else 0.0,
+                "late": self.output_late}
+
+    def _stamp(self):
+        now = self.backend.time()
+        target = getattr(interface.context, "target", None) or getattr(interface.context, "received", None)
+        stamp = now if target is None else now - int(round((time.time() - target) * 1000))
+        # PortMidi expects the timestamps of a stream in order, but a message timed in the future
+        # must not hold back the following ones: they are never stamped later than now
+        stamp = self.last_stamp = max(stamp, min(self.last_stamp, now))
+        self.output_events += 1
+        self.output_lateness_total += now - stamp
+        if now - stamp > self.latency:
+            self.output_late += 1
+        return stamp
+
+    def _write_short(self, status, data1, data2):
+        if self.latency:
+            self.out_device.write([[[status, data1, data2], self._stamp()]])
+        else:
+            self.out_device.write_short(status, data1, data2)
+
     def noteon(self, channel, key, velocity):
-        self.out_device.note_on(key, velocity, channel)
+        self._write_short(0x90 | channel, key, velocity)
 
     def noteoff(self, channel, key, velocity):
-        self.out_device.note_off(key, velocity, channel)
+        self._write_short(0x80 | channel, key, velocity)
 
     def cc(self, channel, cc, data):
-        self.out_device.write_short(0xB0 | channel, cc, data)
+        if cc not in NRPNEncoder.CONTROLLERS:
+            self._write_short(0xB0 | channel, cc, data)
+            return
+        with self.nrpn_lock:
+            self.encoder.reset(channel)
+            self._write_short(0xB0 | channel, cc, data)
+
+    def pitchbend(self, channel, code, value):
+        self._write_short(0xE0 | channel, value & 0x7F, value >> 7)
 
     def nrpn(self, channel, nrpn, data):
-        # TODO: Remove this True and test
-        if True or self.last_nrpn != nrpn:
-            self.cc(channel, 99, nrpn >> 7)
-            self.cc(channel, 98, nrpn & 0x7F)
-            self.last_nrpn = nrpn
-        self.cc(channel, 6, data >> 7)
-        self.cc(channel, 38, data & 0x7F)
-
-    def _getdevice(self, name, is_input):
-        for i in xrange(pym.get_count()):
-            info = pym.get_device_info(i)
-            if info[1] != name:
-                continue
-            if is_input:
-                if info[2]:
-                    return pym.Input(i)
-            else:
-                if info[3]:
-                    return pym.Output(i)
-        raise Exception("Interface (%s, input=%s) was not found!" % (name, is_input))
+        with self.nrpn_lock:
+            self.out_device.write(self.encoder.encode(channel, nrpn, data, self._stamp() if self.latency else 0))
+
+
+def test():
+    # NRPNs read back as written, whichever parameter was selected before
+    encoder, transformer = NRPNEncoder(), MidiTransformer()
+    for nrpn, data in ((10, 16383), (10, 200), (11, 0), (10, 129)):
+        values = [transformer.transform(status & 0x0F, status >> 4, data1, data2)
+                  for (status, data1, data2), timestamp in encoder.encode(1, nrpn, data)]
+        assert values[-1] == ((1, "nrpn", nrpn), data)
+
+    # The echo of a NRPN sent to the Midi interface is suppressed, although its partial values come back first
+    import StringIO
+    import mosc
+    app = mosc.ValueMapperApp(StringIO.StringIO("""
+interfaces: {osc: [0], midi: {in_name: echo, out_name: echo, backend: loopback}}
+output_queue: {osc: false, midi: false}
+suppress: {echo_window: 5}
+mapping:
+- [/1/volume, 10]
+"""))
+    echoes = []
+    app.midi.interface.send = lambda address, *value: echoes.extend(
+        transformer.transform(status & 0x0F, status >> 4, data1, data2)
+        for (status, data1, data2), timestamp in encoder.encode(address[0], address[2], value[0]))
+    sent = []
+    app.osc.interface.send = lambda address, *value: sent.append((address, value))
+    for value in (0.25, 0.5, 0.75):
+        del echoes[:]
+        app.osc.handler("/1/volume", value)
+        for address, data in echoes[:-1]:
+            app.midi.handler(address, data)
+        # The complete value, carried by the last CC, is not sent back
+        count = len(sent)
+        app.midi.handler(*echoes[-1])
+        assert len(sent) == count
+    assert app.midi.suppressed["echo"] >= 3
+
 
+if __name__ == "__main__":
+    test()
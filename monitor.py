@@ -0,0 +1,99 @@
+"""
+Copyright (c) 2013 by Tomer Altman <tomer.altman@gmail.com>
+
+This file is part of MOSC.
+
+MOSC is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+MOSC is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with MOSC.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import sys
+import time
+import threading
+import collections
+
+
+class Monitor(object):
+    """
+    Live view of the traffic. record() only appends to a ring buffer, the formatting and terminal output
+    are done by the monitor's thread, which renders the last value and rate of the busiest addresses fps times a second.
+    When more than size events are recorded between two frames, the oldest are not counted.
+    """
+    def __init__(self, fps=10, size=16384, lines=16, stream=sys.stdout):
+        self.events = collections.deque(maxlen=size)
+        self.period = 1.0 / fps
+        self.lines = lines
+        self.stream = stream
+        self.values = {}
+        self.rates = {}
+        self.counts = collections.defaultdict(int)
+        self.window_start = time.time()
+        self.rendered_lines = 0
+        self.thread = None
+
+    def record(self, source, address, value):
+        self.events.append((source, address, value))
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.period)
+            self.render()
+
+    def collect(self):
+        changed = False
+        while True:
+            try:
+                source, address, value = self.events.popleft()
+            except IndexError:
+                break
+            self.values[source, address] = value
+            self.counts[source, address] += 1
+            changed = True
+        # Rates are measured over windows of a second
+        now = time.time()
+        if now - self.window_start >= 1.0:
+            rates = dict((key, self.counts[key] / (now - self.window_start)) for key in self.values)
+            changed = changed or rates != self.rates
+            self.rates = rates
+            self.counts.clear()
+            self.window_start = now
+        return changed
+
+    def render(self):
+        if not self.collect():
+            return
+        totals = collections.defaultdict(float)
+        for (source, address), rate in self.rates.iteritems():
+            totals[source] += rate
+        keys = sorted(self.values, key=lambda key: (-self.rates.get(key, 0.0), key))[:self.lines]
+        lines = [" | ".join("%s %.0f/s" % (source, rate) for source, rate in sorted(totals.iteritems()))]
+        for key in keys:
+            source, address = key
+            lines.append("%-10s %-40s %-30s %8.1f/s" % (source, address, self._format(self.values[key]), self.rates.get(key, 0.0)))
+        # Move back to the start of the previous frame and overwrite it
+        output = "\x1b[%dF" % self.rendered_lines if self.rendered_lines else ""
+        output += "".join("\x1b[K" + line + "\n" for line in lines)
+        self.stream.write(output)
+        self.stream.flush()
+        self.rendered_lines = len(lines)
+
+    @staticmethod
+    def _format(value):
+        if len(value) == 1:
+            return str(value[0])
+        return str(value)
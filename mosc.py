@@ -17,14 +17,61 @@ You should have received a copy of the GNU General Public License
 along with MOSC.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import sys
+import os
+import time
+import threading
+import traceback
+import json
+import argparse
 import collections
-import yaml
+from interface import context
 import oscinterface
 import midiinterface
-
-def value_transformer(r_in, r_out, before, after):
-    return lambda value: after((before(value) + r_in[0]) * (r_out[1] - r_out[0]) / r_in[1] + r_out[0])
+import pysc
+import ratelimit
+import monitor
+import stats
+import session
+import curves
+import mapcache
+import ringinterface
+
+def create_interface(cls, params):
+    if isinstance(params, dict):
+        return cls(**params)
+    if isinstance(params, list):
+        return cls(*params)
+    return cls(params)
+
+
+def value_transformer(r_in, r_out, before, after, curve=None, inverse=False, size=None):
+    """
+    Transforms values from the r_in range to the r_out range, through the curve given in the map (or its inverse).
+    With size, the transformations of 0 to size - 1 are precomputed into a table.
+    Curved transformations of other inputs are precomputed over the input range, quantized finer than the output.
+    """
+    curve_function = curves.get_curve(curve)[inverse]
+    key = tuple(r_in), tuple(r_out), before, after, curves.curve_key(curve), inverse
+    typecode = "l" if after is int else "d"
+    if curve_function is None:
+        transform = lambda value: after((before(value) + r_in[0]) * (r_out[1] - r_out[0]) / r_in[1] + r_out[0])
+    else:
+        transform = lambda value: after(curve_function((before(value) + r_in[0]) / float(r_in[1])) * (r_out[1] - r_out[0]) + r_out[0])
+
+    if size is not None:
+        return curves.lookup(curves.lookup_table(key, size, transform, typecode), transform)
+    if curve_function is None:
+        return transform
+
+    steps = max(4 * int(abs(r_out[1] - r_out[0])), 1024)
+    table = curves.lookup_table(key, steps + 1, lambda step: after(curve_function(float(step) / steps) * (r_out[1] - r_out[0]) + r_out[0]), typecode)
+
+    def quantized(value):
+        step = int((before(value) + r_in[0]) / r_in[1] * steps + 0.5)
+        if 0 <= step <= steps:
+            return table[step]
+        return transform(value)
+    return quantized
 
 
 def value_transfer(interface, transformer, address):
@@ -58,33 +105,134 @@ class Multi(object):
 
 
 class MOSCInterface(object):
-    def __init__(self, interface):
+    def __init__(self, interface, map=None, name=None, monitor=None, stats=None, direction=None):
         interface.handler = self.handler
         self.interface = interface
-        self.map = {}
-        self.last_address = None
+        self.map = {} if map is None else map
+        self.name = name
+        self.monitor = monitor
+        self.sources = "%s in" % name, "%s out" % name
+        self.stats = stats
+        self.direction = direction
+        self.limiter = None
+        self.on_first = None
+        # Last value of each address, as sent to the interface or received from it, with the time it was sent
+        self.last = {}
+        self.suppressing = False
+        self.suppressed = {"unchanged": 0, "echo": 0}
+        # With an output queue, the write is timed by the queue's thread
+        self.queue = getattr(interface, "queue", None)
+        if stats is not None and self.queue is not None:
+            self.queue.on_write = self._written
 
     def start(self):
         self.interface.start()
 
+    def limit_rate(self, scheduler, rate=None, rates=None):
+        # Replaces all the interface's limits at once, a reload may remove some of them
+        rates = {} if rates is None else rates
+        if self.limiter is None:
+            if rate is None and not rates:
+                return
+            self.limiter = ratelimit.RateLimiter(self._send, scheduler, on_flush=None if self.stats is None else self._queued)
+        self.limiter.intervals = dict((address, ratelimit.interval(r)) for address, r in rates.iteritems())
+        self.limiter.interval = ratelimit.interval(rate)
+
+    def suppress(self, unchanged=False, echo_window=None, exempt=()):
+        self.unchanged = unchanged
+        self.echo_window = echo_window
+        self.exempt = frozenset(exempt)
+        self.suppressing = unchanged or echo_window is not None
+
+    def _suppressed(self, reason, address):
+        self.suppressed[reason] += 1
+        if self.stats is not None:
+            self.stats.route(self.direction, address).suppressed[reason] += 1
+
     def send(self, address, *value):
-        if len(value) == 1:
-            print "-> %s: %s" % (address, value[0]),
+        if self.suppressing and address not in self.exempt:
+            last = self.last.get(address)
+            if self.unchanged and last is not None and last[0] == value:
+                self._suppressed("unchanged", address)
+                return
+            self.last[address] = value, None if self.echo_window is None else time.time()
+        if self.stats is not None:
+            self._sending(address)
+        if self.limiter is not None:
+            self.limiter(address, *value)
         else:
-            print "-> %s: %s" % (address, value),
+            self._send(address, *value)
+
+    def _send(self, address, *value):
+        if self.monitor is not None:
+            self.monitor.record(self.sources[1], address, value)
+        if self.stats is None or self.queue is not None:
+            self.interface.send(address, *value)
+            return
+        start = time.time()
         self.interface.send(address, *value)
+        end = time.time()
+        route = self.stats.route(self.direction, address)
+        route.stages["write"].add(end - start)
+        # Values sent later by the rate limiter are not timed from their reception
+        received = getattr(context, "received", None)
+        if received is not None:
+            route.stages["total"].add(end - received)
+
+    def _sending(self, address):
+        route = self.stats.route(self.direction, address)
+        route.count += 1
+        handled = getattr(context, "handled", None)
+        if handled is None:
+            return
+        route.stages["transform"].add(time.time() - handled)
+        received = getattr(context, "received", None)
+        if received is not None:
+            route.stages["receive"].add(handled - received)
+
+    def _written(self, address, wait, write, end):
+        route = self.stats.route(self.direction, address)
+        route.stages["queue"].add(wait)
+        route.stages["write"].add(write)
+        # The queue's thread carries the reception time of the message along
+        received = getattr(context, "received", None)
+        if received is not None:
+            route.stages["total"].add(end - received)
+
+    def _queued(self, address, delay):
+        self.stats.route(self.direction, address).stages["queue"].add(delay)
 
     def handler(self, address, *value):
-        if address != self.last_address:
-            self.last_address = address
-            print
-            print "%s:" % (address, )
+        if self.on_first is not None:
+            self.on_first()
+        if self.monitor is not None:
+            self.monitor.record(self.sources[0], address, value)
+        if self.suppressing and address not in self.exempt:
+            last = self.last.get(address)
+            if last is not None and last[1] is not None and time.time() - last[1] < self.echo_window:
+                # A value coming back the same as just sent is the interface echoing it
+                if last[0] == value:
+                    self._suppressed("echo", address)
+                    context.received = None
+                    return
+                # Others, such as the partial values of a NRPN echo, keep the sent value for the echo to come
+            else:
+                # Otherwise it is the interface's own value, that later values sent to it are compared to
+                self.last[address] = value, None
+        if self.stats is not None:
+            context.handled = time.time()
 
-        print "\r" + 100 * " " + "\r",
-        print value,
+        # The map may be swapped by a reload at any time, so it is read once per message
+        map = self.map
+        route = map.get(address)
+        if route is not None:
+            route(*value)
+        elif isinstance(map, pysc.AddressMap):
+            for route in map.match(address):
+                route(*value)
 
-        if address in self.map:
-            self.map[address](*value)
+        if self.stats is not None:
+            context.handled = context.received = None
 
 
 class MapPart(object):
@@ -95,8 +243,10 @@ class MapPart(object):
 class MidiValueMapPart(MapPart):
     def __init__(self, code, type="nrpn", range_min=0, range_max=None, channel=0):
         self.address = channel, type, code
+        # Number of different values of the Midi message
+        self.resolution = 16384 if type in ("nrpn", "pitchbend") else 128
         if range_max is None:
-            range_max = 16383 if type == "nrpn" else 127
+            range_max = self.resolution - 1
         self.param = range_min, range_max
 
 
@@ -107,75 +257,257 @@ class OSCValueMapPart(MapPart):
         self.index = index
 
 
-class ValueMapperApp(object):
-    def __init__(self, stream):
-        data = yaml.load(stream)
-        self.osc = MOSCInterface(oscinterface.OSCInterface(*data["interfaces"]["osc"]))
-        self.midi = MOSCInterface(midiinterface.MidiInterface(*data["interfaces"]["midi"]))
-
-        mapping = self.read_mapping(data)
-        multis = self.get_multis(mapping)
-
-        for addr, multi in multis.iteritems():
-            self.osc.map[addr] = multi.single_to_multi
-
-        for osc_part, midi_part, direction in mapping:
-            if osc_part.address in multis:
-                multi = multis[osc_part.address]
-                if direction != "<":
-                    multi.add(midi_part.address, self.osc_2_midi(osc_part, midi_part))
-                if direction != ">":
-                    self.midi.map[midi_part.address] = multi.multi_to_single(osc_part.address, osc_part.index, self.midi_2_osc(osc_part, midi_part)) 
+class MapWatcher(threading.Thread):
+    """
+    Reloads the application's map when its file changes on disk.
+    """
+    def __init__(self, app, path, period=1.0, cache=True):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.app = app
+        self.path = path
+        self.cache = cache
+        self.period = period
+        self.mtime = os.stat(path).st_mtime
+
+    def run(self):
+        while True:
+            time.sleep(self.period)
+            try:
+                mtime = os.stat(self.path).st_mtime
+            except OSError:
+                # Editors may replace the file, it comes back on the next poll
+                continue
+            if mtime == self.mtime:
+                continue
+            self.mtime = mtime
+            try:
+                kept, built = self.app.reload(mapcache.load(self.path, self.cache)[0])
+            except Exception:
+                print "Reloading %s failed, keeping the current map:" % self.path
+                traceback.print_exc()
             else:
-                if direction != "<":
-                    self.osc.map[osc_part.address] = value_transfer(self.midi, self.osc_2_midi(osc_part, midi_part), midi_part.address)
-                if direction != ">":
-                    self.midi.map[midi_part.address] = value_transfer(self.osc, self.midi_2_osc(osc_part, midi_part), osc_part.address)
+                print "Reloaded %s: %d routes kept, %d built" % (self.path, kept, built)
+
+
+class ValueMapperApp(object):
+    STATS_ADDRESS = "/mosc/stats"
+
+    def __init__(self, stream, monitor=None, stats=None, interfaces=None):
+        # The map is either a yaml stream or a table already compiled by mapcache
+        self.timings = collections.OrderedDict()
+        start = time.time()
+        table = self.compile(stream)
+        self.timings["parse"] = time.time() - start
+        self.monitor = monitor
+        self.stats = stats
+        # Interfaces may be given already created, by name, instead of from the map's initializers
+        start = time.time()
+        interfaces = {} if interfaces is None else interfaces
+        osc = interfaces.get("osc") or self.create_interface("osc", oscinterface.OSCInterface, table)
+        midi = interfaces.get("midi") or self.create_interface("midi", midiinterface.MidiInterface, table)
+        self.timings["open"] = time.time() - start
+        self.osc = MOSCInterface(osc, pysc.AddressMap(), "osc", monitor, stats, "midi->osc")
+        self.midi = MOSCInterface(midi, None, "midi", monitor, stats, "osc->midi")
+        server = getattr(osc, "server", None)
+        if stats is not None and server is not None:
+            server.scheduler.on_dispatch = lambda when, late: stats.scheduled.add(late)
+        self.scheduler = pysc.Scheduler()
+        self.routes = {}
+        self.reload_lock = threading.Lock()
+        start = time.time()
+        self.load(table)
+        self.timings["compile"] = time.time() - start
 
     @staticmethod
-    def osc_2_midi(osc_part, midi_part):
-        return value_transformer(osc_part.param, midi_part.param, float, int)
+    def create_interface(name, cls, table):
+        created = create_interface(cls, table["interfaces"][name])
+        # Interfaces created from the map write their output from their own thread, unless disabled
+        queue = table["output_queue"].get(name, {})
+        if queue is not False:
+            created.queue_output(**(queue or {}))
+        return created
 
     @staticmethod
-    def midi_2_osc(osc_part, midi_part):
-        return value_transformer(midi_part.param, osc_part.param, float, float)
-
-    def read_mapping(self, data):
-        mapping = []
-        for mapparts in data["mapping"]:
-            if len(mapparts) > 2:
-                direction = mapparts[2]
-                mapparts = mapparts[:2]
+    def compile(stream):
+        return stream if isinstance(stream, dict) else mapcache.compile_map(mapcache.parse(stream))
+
+    def reload(self, stream):
+        # Interfaces stay open, only the routing is rebuilt
+        with self.reload_lock:
+            return self.load(self.compile(stream))
+
+    def load(self, table):
+        mapping = self.read_mapping(table)
+        # Entries are compared by their normalized text, unchanged ones keep their built routes
+        keys = [key for key, osc_args, midi_args, direction, options in table["mapping"]]
+        groups = self.get_multis(mapping, keys)
+        osc_map = pysc.AddressMap()
+        midi_map = {}
+        routes = {}
+        positions = collections.defaultdict(int)
+        rates = {"osc": {}, "midi": {}}
+        exempt = {"osc": [], "midi": []}
+
+        for key, (osc_part, midi_part, direction, options) in zip(keys, mapping):
+            if "rate_limit" in options:
+                rates["osc"][osc_part.address] = options["rate_limit"]
+                rates["midi"][midi_part.address] = options["rate_limit"]
+            if not options.get("suppress", True):
+                exempt["osc"].append(osc_part.address)
+                exempt["midi"].append(midi_part.address)
+            if osc_part.address in groups:
+                group_key, group = groups[osc_part.address]
+                if group_key not in routes:
+                    routes[group_key] = self.routes.get(group_key) or self.build_multi(group)
+                multi, midi_routes = routes[group_key]
+                osc_map[osc_part.address] = multi.single_to_multi
+                midi_route = midi_routes[positions[osc_part.address]]
+                positions[osc_part.address] += 1
             else:
-                direction = "="
-
-            osc_part = self.read_part(mapparts[0], OSCValueMapPart)
-            midi_part = self.read_part(mapparts[1], MidiValueMapPart)
+                if key not in routes:
+                    routes[key] = self.routes.get(key) or self.build_route(osc_part, midi_part, direction, options)
+                osc_route, midi_route = routes[key]
+                if osc_route is not None:
+                    osc_map[osc_part.address] = osc_route
+            if midi_route is not None:
+                midi_map[midi_part.address] = midi_route
+
+        if self.stats is not None:
+            osc_map[self.STATS_ADDRESS] = self.send_stats
+
+        # Rate limits given per interface apply to every address sent to the interface
+        rate_limit = table["rate_limit"]
+        for name in ("osc", "midi"):
+            getattr(self, name).limit_rate(self.scheduler, rate_limit.get(name), rates[name])
+            getattr(self, name).suppress(exempt=exempt[name], **table["suppress"])
+
+        kept = len(set(routes) & set(self.routes))
+        self.routes = routes
+        # Handlers read the maps once per message, so assigning them is the whole swap
+        self.osc.map = osc_map
+        self.midi.map = midi_map
+        return kept, len(routes) - kept
+
+    def build_route(self, osc_part, midi_part, direction, options):
+        osc_route = midi_route = None
+        if direction != "<":
+            osc_route = value_transfer(self.midi, self.osc_2_midi(osc_part, midi_part, options.get("curve")), midi_part.address)
+        if direction != ">":
+            midi_route = value_transfer(self.osc, self.midi_2_osc(osc_part, midi_part, options.get("curve")), osc_part.address)
+        return osc_route, midi_route
+
+    def build_multi(self, group):
+        multi = Multi(max(osc_part.index for osc_part, midi_part, direction, options in group) + 1, self.osc, self.midi)
+        midi_routes = []
+        for osc_part, midi_part, direction, options in group:
+            midi_route = None
+            if direction != "<":
+                multi.add(midi_part.address, self.osc_2_midi(osc_part, midi_part, options.get("curve")))
+            if direction != ">":
+                midi_route = multi.multi_to_single(osc_part.address, osc_part.index, self.midi_2_osc(osc_part, midi_part, options.get("curve")))
+            midi_routes.append(midi_route)
+        return multi, midi_routes
 
-            mapping.append((osc_part, midi_part, direction))
-        return mapping
-
-    def get_multis(self, mapping):
-        multi_max = collections.defaultdict(int)
-        for osc_part, midi_part, direction in mapping:
-            if osc_part.index > 0:
-                multi_max[osc_part.address] = max(multi_max[osc_part.address], osc_part.index)
-        return dict((addr, Multi(mx + 1, self.osc, self.midi)) for addr, mx in multi_max.iteritems())
+    @staticmethod
+    def osc_2_midi(osc_part, midi_part, curve=None):
+        return value_transformer(osc_part.param, midi_part.param, float, int, curve)
 
-    def read_part(self, part, reader):
-        if isinstance(part, list):
-            return reader(*part)
-        else:
-            return reader(part)
+    @staticmethod
+    def midi_2_osc(osc_part, midi_part, curve=None):
+        return value_transformer(midi_part.param, osc_part.param, float, float, curve, True, midi_part.resolution)
+
+    def read_mapping(self, table):
+        return [(OSCValueMapPart(*osc_args), MidiValueMapPart(*midi_args), direction, options)
+                for key, osc_args, midi_args, direction, options in table["mapping"]]
+
+    def get_multis(self, mapping, keys):
+        # A multi is rebuilt whole when any of its entries changes
+        entries = collections.defaultdict(list)
+        for key, entry in zip(keys, mapping):
+            entries[entry[0].address].append((key, entry))
+        groups = {}
+        for addr, group in entries.iteritems():
+            if any(osc_part.index > 0 for key, (osc_part, midi_part, direction, options) in group):
+                groups[addr] = tuple(key for key, entry in group), [entry for key, entry in group]
+        return groups
+
+    def send_stats(self, match="", *ignored):
+        # Answered directly, bypassing rate limits and statistics.
+        # One message per route keeps each datagram small whatever the size of the map
+        snapshot = self.stats.snapshot(match if isinstance(match, basestring) else "")
+        routes = snapshot.pop("routes")
+        snapshot["routes"] = len(routes)
+        send = self.osc.interface.send
+        send(self.STATS_ADDRESS, json.dumps(snapshot, sort_keys=True))
+        for name in sorted(routes):
+            send(self.STATS_ADDRESS, name, json.dumps(routes[name], sort_keys=True))
+
+    def _first_message(self):
+        self.osc.on_first = self.midi.on_first = None
+        if "first message" not in self.timings:
+            self.timings["first message"] = time.time() - self.started
+            print "First message %.3fs after starting" % self.timings["first message"]
 
     def start(self):
+        if self.monitor is not None:
+            self.monitor.start()
+        self.started = time.time()
+        self.osc.on_first = self.midi.on_first = self._first_message
         self.osc.start()
         self.midi.start()
 
 
 if __name__ == "__main__":
-    mapname = sys.argv[1] if len(sys.argv) > 1 else "defaultmap.txt"
-    app = ValueMapperApp(open(mapname))
+    parser = argparse.ArgumentParser()
+    parser.add_argument("mapname", nargs="?", default="defaultmap.txt")
+    parser.add_argument("-q", "--quiet", action="store_true", help="Do not display the traffic")
+    parser.add_argument("--fps", type=float, default=10, help="Refresh rate of the traffic display")
+    parser.add_argument("--stats", action="store_true", help="Measure latencies, answered on %s" % ValueMapperApp.STATS_ADDRESS)
+    parser.add_argument("--stats-file", help="Dump the statistics as JSON to this file periodically")
+    parser.add_argument("--stats-period", type=float, default=10, help="Seconds between statistics dumps")
+    parser.add_argument("--watch", action="store_true", help="Reload the map when its file changes")
+    parser.add_argument("--no-cache", action="store_true", help="Do not read or write the compiled map cache")
+    parser.add_argument("--osc-process", action="store_true", help="Receive and send OSC in a separate process")
+    parser.add_argument("--record", help="Record the session's traffic to this log, for replaying with session.py")
+    args = parser.parse_args()
+    app_stats = stats.Stats() if args.stats or args.stats_file else None
+    start = time.time()
+    table, cached = mapcache.load(args.mapname, not args.no_cache)
+    parse_time = time.time() - start
+    interfaces = {}
+    if args.osc_process:
+        # Addresses known to both processes travel between them as a number
+        addresses = sorted(set(osc_args[0] for key, osc_args, midi_args, direction, options in table["mapping"]))
+        interfaces["osc"] = ringinterface.RingInterface(table["interfaces"]["osc"], addresses + [ValueMapperApp.STATS_ADDRESS])
+    app = ValueMapperApp(table, None if args.quiet else monitor.Monitor(args.fps), app_stats, interfaces)
+    app.timings["parse"] = parse_time
+    if args.stats_file:
+        app_stats.start_dump(args.stats_file, args.stats_period)
+    recorder = None
+    if args.record:
+        recorder = session.Recorder(args.record)
+        recorder.attach(app)
     app.start()
-    print "MOSC Started!"
+    if args.watch:
+        MapWatcher(app, args.mapname, cache=not args.no_cache).start()
+    print "MOSC Started! (parse %.3fs%s, open %.3fs, compile %.3fs)" % (
+        app.timings["parse"], " cached" if cached else "", app.timings["open"], app.timings["compile"])
     raw_input("Press return to finish...\n")
+    for name in ("osc", "midi"):
+        if getattr(app, name).suppressing:
+            print "Suppressed on %s: %s" % (name, getattr(app, name).suppressed)
+        if getattr(app, name).interface.queue is not None:
+            print "Output queue of %s: %s" % (name, getattr(app, name).interface.queue.stats())
+    if isinstance(app.osc.interface, ringinterface.RingInterface):
+        print "Dropped between the processes: %s" % app.osc.interface.dropped()
+    if hasattr(app.osc.interface, "server"):
+        print "Timed OSC bundles: %s" % app.osc.interface.server.scheduler.stats()
+    if isinstance(getattr(app.osc.interface, "client", None), pysc.BatchingClient):
+        print "OSC batching: %s" % app.osc.interface.client.stats()
+    if isinstance(app.midi.interface, midiinterface.MidiInterface):
+        print "Midi input latency: %s" % app.midi.interface.input_stats()
+    if getattr(app.midi.interface, "latency", 0):
+        print "Timed Midi output: %s" % app.midi.interface.output_stats()
+    if recorder is not None:
+        recorder.close()
@@ -17,19 +17,33 @@ You should have received a copy of the GNU General Public License
 along with MOSC.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import SocketServer
 import interface
 import pysc
 
 
 class OSCInterface(interface.Interface):
-    def __init__(self, server_address, client_address=None):
+    # "threading" handles each datagram on its own thread, "loop" handles all of them in order on a single thread
+    SERVER_MODES = {"threading": SocketServer.ThreadingUDPServer,
+                    "loop": pysc.EventLoopUDPServer}
+
+    def __init__(self, server_address, client_address=None, mode="threading", batch_window=None, mtu=1472,
+                 clients=1, client_timeout=None, multicast_ttl=1):
         super(OSCInterface, self).__init__()
         self.server_address = "0.0.0.0", server_address if isinstance(server_address, int) else server_address
-        self.server = pysc.Server(self.server_address, self._message_handler)
-        self.client = None if client_address is None else pysc.Client(client_address)
+        self.server = pysc.Server(self.server_address, self._message_handler, self.SERVER_MODES[mode])
+        # Senders are registered as clients up to the limit, a fixed client address takes one of the places
+        self.clients = pysc.MultiClient(clients, client_timeout, multicast_ttl)
+        if isinstance(client_address, basestring):
+            client_address = client_address, self.server_address[1]
+        if client_address is not None:
+            self.clients.add(tuple(client_address))
+        self.client = self.clients
+        if batch_window is not None:
+            self.client = pysc.BatchingClient(self.clients, batch_window, mtu, self.server.scheduler)
 
     def send(self, address, *value):
-        if self.client is None:
+        if not self.clients.addresses:
             return
         self.client.send(pysc.Message(address, *value))
 
@@ -37,10 +51,11 @@ class OSCInterface(interface.Interface):
         self.server.serve_forever()
 
     def _message_handler(self, message, client_address):
-        if self.client is None:
-            self.client = pysc.Client((client_address[0], self.server_address[1]))
+        self.clients.add((client_address[0], self.server_address[1]), message.received)
 
         if self.handler is None:
             return
 
+        interface.context.received = message.received
+        interface.context.target = message.timetag
         self.handler(message.address, *message.args)
\ No newline at end of file
@@ -22,6 +22,13 @@ import math
 import time
 import datetime
 import types
+import heapq
+import itertools
+import threading
+import traceback
+import select
+import errno
+import re
 
 
 def _maketype(name, base):
@@ -31,7 +38,20 @@ Time = _maketype("Time", float)
 Blob = _maketype("Blob", str)
 
 
+def plain(value):
+    # marshal only handles the exact builtin types, not Time and Blob
+    if isinstance(value, float):
+        return float(value)
+    if isinstance(value, str):
+        return str(value)
+    return value
+
+
 class Message(object):
+    # Time the packet holding the message was received, and the time tag of its bundle if it is timed, set by Server
+    received = None
+    timetag = None
+
     def __init__(self, address, *args):
         self.address, self.args = address, args
 
@@ -58,112 +78,253 @@ NTP_DELTA = (datetime.date(*time.gmtime(0)[0:3]) - datetime.date(1900, 1, 1)).da
 NTP_UNITS = 0x100000000
 
 
-def serialize(message):
-    def _null(value):
-        return ""
-    
-    def _int(value):
-        return struct.pack('>i', value)
-
-    def _float(value):
-        return struct.pack('>f', value)
-
-    def _string(value):
-        length = len(value)
-        length += (3 - length) % 4
-        return struct.pack(str(length) + 'ss', value, '\x00')
-
-    def _time(value):
-        if value < 0.0:
-            return struct.pack('>LL', 0L, 1L)
-        fractional, seconds = math.modf(value)
-        fractional = int(fractional * NTP_UNITS)
-        if fractional >= NTP_UNITS:
-            fractional = NTP_UNITS - 1
-        return struct.pack('>LL', seconds + NTP_DELTA, fractional)
-
-    def _blob(value):
-        length = len(value)
-        padded = length + (4 - length) % 4
-        return struct.pack('>i' + str(padded) + 's', length, value)
-
-    mapping = {int: ("i", _int),
-               str: ("s", _string),
-               Time: ("t", _time),
-               Blob: ("b", _blob),
-               float: ("f", _float),
-               types.NoneType: ("N", _null)}
+_INT = struct.Struct('>i')
+_FLOAT = struct.Struct('>f')
+_TIME = struct.Struct('>LL')
+
+
+def _pack_null(value):
+    return ""
+
+
+def _pack_int(value):
+    return _INT.pack(value)
+
+
+def _pack_float(value):
+    return _FLOAT.pack(value)
+
+
+def _pack_string(value):
+    return value + '\x00' * (4 - len(value) % 4)
+
+
+def _timetag(value):
+    if value < 0.0:
+        return 0L, 1L
+    fractional, seconds = math.modf(value)
+    fractional = int(fractional * NTP_UNITS)
+    if fractional >= NTP_UNITS:
+        fractional = NTP_UNITS - 1
+    return int(seconds) + NTP_DELTA, fractional
+
+
+def _pack_time(value):
+    return _TIME.pack(*_timetag(value))
+
+
+def _pack_blob(value):
+    length = len(value)
+    padded = length + (4 - length) % 4
+    return struct.pack('>i' + str(padded) + 's', length, value)
+
+
+_TYPES = {int: ("i", _pack_int),
+          str: ("s", _pack_string),
+          Time: ("t", _pack_time),
+          Blob: ("b", _pack_blob),
+          float: ("f", _pack_float),
+          types.NoneType: ("N", _pack_null)}
+
+_TAG_TYPES = dict((tag, type_) for type_, (tag, packer) in _TYPES.iteritems())
+
+# Struct formats of the typetags which have a fixed size on the wire
+_FIXED_FORMATS = {'i': 'i', 'f': 'f', 't': 'LL', 'N': ''}
+
+
+class MessageCodec(object):
+    """
+    Packs and unpacks the arguments of messages sharing an address and typetags.
+    Signatures made of fixed size arguments only are compiled into a single struct.
+    """
+    def __init__(self, address, typetags):
+        self.address = address
+        self.typetags = typetags
+        self.header = _pack_string(address) + _pack_string(typetags)
+        tags = typetags[1:]
+        self.packers = [_TYPES[_TAG_TYPES[tag]][1] for tag in tags]
+        self.plain = all(tag in "if" for tag in tags)
+        self.fixed = all(tag in _FIXED_FORMATS for tag in tags)
+        if self.fixed:
+            fmt = ''.join(_FIXED_FORMATS[tag] for tag in tags)
+            self.struct = struct.Struct('>%ds%s' % (len(self.header), fmt))
+            self.args_struct = struct.Struct('>' + fmt)
+            self.tags = tags
+
+    def encode(self, args):
+        if self.plain:
+            return self.struct.pack(self.header, *args)
+        if self.fixed:
+            values = []
+            for tag, arg in zip(self.tags, args):
+                if tag == 't':
+                    values.extend(_timetag(arg))
+                elif tag != 'N':
+                    values.append(arg)
+            return self.struct.pack(self.header, *values)
+        return self.header + "".join([packer(arg) for packer, arg in zip(self.packers, args)])
+
+    def decode(self, stream):
+        if not self.fixed:
+            return [stream.tag_mapping[tag](stream) for tag in self.typetags[1:]]
+        stream._check(self.args_struct.size)
+        values = self.args_struct.unpack_from(stream.packet, stream.offset)
+        stream.offset += self.args_struct.size
+        if self.plain:
+            return values
+        args = []
+        values = iter(values)
+        for tag in self.tags:
+            if tag == 'N':
+                args.append(None)
+            elif tag == 't':
+                args.append(_time_from_ntp(next(values), next(values)))
+            else:
+                args.append(next(values))
+        return args
+
+
+def _time_from_ntp(seconds, fractional):
+    return Time(seconds - NTP_DELTA + float(fractional) / NTP_UNITS)
+
+
+CODEC_CACHE_SIZE = 4096
+_encoders = {}
+_decoders = {}
+
+
+def _cache(cache, key, codec):
+    if len(cache) >= CODEC_CACHE_SIZE:
+        cache.clear()
+    cache[key] = codec
+    return codec
+
+
+def _encoder(address, args):
+    argtypes = tuple([type(arg) for arg in args])
+    codec = _encoders.get((address, argtypes))
+    if codec is None:
+        typetags = "," + "".join(_TYPES[argtype][0] for argtype in argtypes)
+        codec = _cache(_encoders, (address, argtypes), MessageCodec(address, typetags))
+    return codec
+
+
+def _decoder(address, typetags):
+    key = address, typetags
+    codec = _decoders.get(key)
+    if codec is None:
+        codec = _cache(_decoders, key, MessageCodec(address, typetags))
+    return codec
+
 
+def serialize(message):
     if isinstance(message, Bundle):
-        buffer = [_string("#bundle")]
-        buffer.append(_time(message.timetag))        
+        buffer = [_pack_string("#bundle"), _pack_time(message.timetag)]
         for element in message.elements:
             data = serialize(element)
-            buffer.append(_int(len(data)))  
+            buffer.append(_pack_int(len(data)))
             buffer.append(data)
         return "".join(buffer)
 
-    # Message
-    buffer = [_string(message.address), None]
-    typetags = [","]
-    for arg in message.args:
-      tag, serializer = mapping[type(arg)]
-      buffer.append(serializer(arg))
-      typetags.append(tag)
-    buffer[1] = _string("".join(typetags))
-    return "".join(buffer)
+    return _encoder(message.address, message.args).encode(message.args)
+
+
+class LazyMessage(Message):
+    """
+    A message whose arguments are decoded from the packet only when first accessed.
+    detach() must be called before the packet buffer is reused, it copies the message's bytes out of the buffer.
+    Decoding and detaching are done under a lock, so arguments read from any thread never come from a reused buffer.
+    """
+    _lock = threading.Lock()
+
+    def __init__(self, address, codec, packet, offset, end):
+        self.address = address
+        self._codec = codec
+        self._packet, self._offset, self._end = packet, offset, end
+        self._args = None
+
+    @property
+    def args(self):
+        if self._args is None:
+            with self._lock:
+                if self._args is None:
+                    self._args = tuple(self._codec.decode(DeserializerStream(self._packet, self._end, self._offset)))
+                    self._packet = None
+        return self._args
+
+    def detach(self):
+        with self._lock:
+            if self._packet is None or isinstance(self._packet, str):
+                return
+            self._packet = memoryview(self._packet)[self._offset:self._end].tobytes()
+            self._offset, self._end = 0, len(self._packet)
 
 
 class DeserializerStream(object):
-    def __init__(self, packet):
+    def __init__(self, packet, length=None, offset=0, lazy=False):
         self.packet = packet
-        self.offset = 0
+        self.length = len(packet) if length is None else length
+        self.offset = offset
+        self.view = None if isinstance(packet, str) else memoryview(packet)
+        self.lazy = lazy
+        self.lazy_messages = []
+
+    def _check(self, size):
+        # A pooled buffer goes on past the datagram with the bytes of previous ones, which must not be read
+        if self.offset + size > self.length:
+            raise struct.error("Truncated packet: %d bytes needed at offset %d of %d" % (size, self.offset, self.length))
 
     def _unpack(self, fmt):
-        value = struct.unpack_from(fmt, self.packet, self.offset)[0]
-        self.offset += struct.calcsize(fmt)
+        self._check(fmt.size)
+        value = fmt.unpack_from(self.packet, self.offset)
+        self.offset += fmt.size
         return value
 
     def _pad(self):
         self.offset += (4 - self.offset) % 4
 
+    def _bytes(self, start, end):
+        if self.view is None:
+            return self.packet[start:end]
+        return self.view[start:end].tobytes()
+
     def _int(self):
-        return self._unpack('>i')
+        return self._unpack(_INT)[0]
 
     def _float(self):
-        return self._unpack('>f')
+        return self._unpack(_FLOAT)[0]
 
     def _null(self):
         return None
 
     def _time(self):
-        seconds = self._unpack('>L')
-        fractional = float(self._unpack('>L'))
-        fractional /= NTP_UNITS
-        return Time(seconds - NTP_DELTA + fractional)
+        return _time_from_ntp(*self._unpack(_TIME))
 
     def _string(self):
-        end = self.packet.index('\x00', self.offset)
-        value = self.packet[self.offset:end]
+        end = self.packet.index('\x00', self.offset, self.length)
+        value = self._bytes(self.offset, end)
         self.offset = end + 1
         self._pad()
         return value
 
     def _blob(self):
-        length = self._unpack('>i')
-        value = self.packet[self.offset:(self.offset + length)]
+        length = self._int()
+        self._check(length)
+        value = self._bytes(self.offset, self.offset + length)
         self.offset += length
         self._pad()
         return Blob(value)
 
-    def read(self):
+    def read(self, end=None):
         address = self._string()
         if address == '#bundle':
             timetag = self._time()
             elements = []
-            while self.offset < len(self.packet):
-                maxoffset = self._int() + self.offset
-                elements.append(self.read())
+            while self.offset < (self.length if end is None else end):
+                size = self._int()
+                self._check(size)
+                maxoffset = size + self.offset
+                elements.append(self.read(maxoffset))
                 if self.offset > maxoffset:
                     raise Exception("Invalid bundle. Offset was %s while expected <= %s", self.offset, maxoffset)
             return Bundle(timetag, *elements)
@@ -171,7 +332,19 @@ class DeserializerStream(object):
         typetags = self._string()
         if not typetags.startswith(','):
             raise Exception('Invalid message')
-        return Message(address, *[self.tag_mapping[typetag](self) for typetag in typetags[1:]])
+        codec = _decoder(address, typetags)
+        if not self.lazy:
+            return Message(address, *codec.decode(self))
+        end = self.length if end is None else end
+        message = LazyMessage(address, codec, self.packet, self.offset, end)
+        self.lazy_messages.append(message)
+        self.offset = end
+        return message
+
+    def detach(self):
+        for message in self.lazy_messages:
+            message.detach()
+        self.lazy_messages = []
 
     tag_mapping = {'i': _int, 'f': _float, "N": _null, 't': _time, 's': _string, 'b': _blob}
 
@@ -180,37 +353,466 @@ def deserialize(packet):
     return DeserializerStream(packet).read()
 
 
+PATTERN_CHARS = "*?[{"
+
+
+def is_pattern(address):
+    return any(char in address for char in PATTERN_CHARS)
+
+
+def _translate_segment(segment):
+    i, parts = 0, []
+    while i < len(segment):
+        char = segment[i]
+        i += 1
+        if char == "*":
+            parts.append("[^/]*")
+        elif char == "?":
+            parts.append("[^/]")
+        elif char == "[" and "]" in segment[i:]:
+            end = segment.index("]", i)
+            body = segment[i:end].replace("\\", "\\\\")
+            if body.startswith("!"):
+                body = "^" + body[1:]
+            elif body.startswith("^"):
+                body = "\\" + body
+            parts.append("[%s]" % body)
+            i = end + 1
+        elif char == "{" and "}" in segment[i:]:
+            end = segment.index("}", i)
+            parts.append("(?:%s)" % "|".join(re.escape(choice) for choice in segment[i:end].split(",")))
+            i = end + 1
+        else:
+            parts.append(re.escape(char))
+    return re.compile("".join(parts) + r"\Z")
+
+
+class AddressMap(dict):
+    """
+    A dict of OSC addresses which also resolves OSC address patterns (*, ?, [], {}) to the values of all matching addresses.
+    Addresses are kept in a trie of their segments, and resolved patterns are cached until the map changes.
+    Both caches are emptied when they reach cache_size entries, as their keys come from the clients.
+    """
+    cache_size = 4096
+    _segments = {}
+
+    def __init__(self, *args, **kwargs):
+        super(AddressMap, self).__init__()
+        self.trie = {}
+        self.resolved = {}
+        self.update(*args, **kwargs)
+
+    def __setitem__(self, address, value):
+        super(AddressMap, self).__setitem__(address, value)
+        node = self.trie
+        for segment in address.split("/"):
+            node = node.setdefault(segment, {})
+        node[None] = address
+        self.resolved = {}
+
+    def __delitem__(self, address):
+        super(AddressMap, self).__delitem__(address)
+        self._rebuild()
+
+    def update(self, *args, **kwargs):
+        for address, value in dict(*args, **kwargs).iteritems():
+            self[address] = value
+
+    def pop(self, address, *default):
+        value = super(AddressMap, self).pop(address, *default)
+        self._rebuild()
+        return value
+
+    def clear(self):
+        super(AddressMap, self).clear()
+        self._rebuild()
+
+    def _rebuild(self):
+        items = self.items()
+        super(AddressMap, self).clear()
+        self.trie = {}
+        self.resolved = {}
+        self.update(items)
+
+    def match(self, pattern):
+        values = self.resolved.get(pattern)
+        if values is None:
+            if pattern in self:
+                values = [self[pattern]]
+            elif is_pattern(pattern):
+                addresses = []
+                self._match(self.trie, pattern.split("/"), 0, addresses)
+                values = [self[address] for address in sorted(addresses)]
+            else:
+                values = []
+            if len(self.resolved) >= self.cache_size:
+                self.resolved = {}
+            self.resolved[pattern] = values
+        return values
+
+    def _match(self, node, segments, index, addresses):
+        if index == len(segments):
+            if None in node:
+                addresses.append(node[None])
+            return
+        segment = segments[index]
+        if not is_pattern(segment):
+            if segment in node:
+                self._match(node[segment], segments, index + 1, addresses)
+            return
+        compiled = AddressMap._segments
+        regex = compiled.get(segment)
+        if regex is None:
+            if len(compiled) >= self.cache_size:
+                compiled.clear()
+            regex = compiled[segment] = _translate_segment(segment)
+        for key, child in node.iteritems():
+            if key is not None and regex.match(key):
+                self._match(child, segments, index + 1, addresses)
+
+
 class Client(object):
     def __init__(self, address):
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.socket.connect(address)
 
     def send(self, message):
-        self.socket.send(serialize(message))
+        self.send_raw(serialize(message))
 
+    def send_raw(self, data):
+        self.socket.send(data)
 
-class Server(object):
-    def __init__(self, address, handler, serverclass = SocketServer.ThreadingUDPServer):
-        class Unbundler(SocketServer.DatagramRequestHandler):
-            def handle(self):
-                self.handle_element(deserialize(self.packet))
 
-            def handle_element(self, element):
-                if isinstance(element, Message):
-                    handler(element, self.client_address)
-                    return 
-                diff = element.timetag - time.time()
+class MultiClient(object):
+    """
+    Sends every packet to all the registered clients from a single socket, serializing it only once.
+    Clients added with a time are dropped once they are not seen for timeout seconds, clients added without one stay.
+    Broadcast and multicast group addresses can be added like any client.
+    A client the packet cannot be sent to is counted in errors and skipped, the others still get the packet.
+    """
+    def __init__(self, limit=None, timeout=None, multicast_ttl=1):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, multicast_ttl)
+        self.limit = limit
+        self.timeout = timeout
+        self.seen = {}
+        # Snapshot of the addresses, replaced as a whole so senders never iterate over a changing dict
+        self.addresses = ()
+        self.lock = threading.Lock()
+        self.next_expiry = None
+        self.packets = 0
+        self.datagrams = 0
+        self.errors = 0
+
+    def add(self, address, now=None):
+        if self.timeout is None:
+            now = None
+        if address in self.seen and now is None:
+            return True
+        with self.lock:
+            # Checked again under the lock, as expire() may have just dropped the address
+            if address in self.seen:
+                self.seen[address] = now
+            else:
+                if self.limit is not None and len(self.seen) >= self.limit:
+                    return False
+                self.seen[address] = now
+                self.addresses = tuple(self.seen)
+                if now is not None and self.next_expiry is None:
+                    self.next_expiry = now + self.timeout
+                return True
+        if self.next_expiry is not None and now >= self.next_expiry:
+            self.expire(now)
+        return True
+
+    def remove(self, address):
+        with self.lock:
+            if self.seen.pop(address, False) is not False:
+                self.addresses = tuple(self.seen)
+
+    def expire(self, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            idle = [address for address, seen in self.seen.iteritems() if seen is not None and now - seen > self.timeout]
+            for address in idle:
+                del self.seen[address]
+            self.addresses = tuple(self.seen)
+            expiring = [seen for seen in self.seen.itervalues() if seen is not None]
+            self.next_expiry = min(expiring) + self.timeout if expiring else None
+        return idle
+
+    def send(self, message):
+        self.send_raw(serialize(message))
+
+    def send_raw(self, data):
+        if self.next_expiry is not None and time.time() >= self.next_expiry:
+            self.expire()
+        addresses = self.addresses
+        sent = 0
+        for address in addresses:
+            try:
+                self.socket.sendto(data, address)
+                sent += 1
+            except socket.error:
+                self.errors += 1
+        self.packets += 1
+        self.datagrams += sent
+
+    def stats(self):
+        return {"clients": len(self.addresses), "packets": self.packets, "datagrams": self.datagrams, "errors": self.errors}
+
+
+# Bundle header with the "immediately" timetag
+_IMMEDIATE_BUNDLE = _pack_string("#bundle") + _pack_time(-1)
+
+
+class BatchingClient(object):
+    """
+    Collects the messages sent within a time window and sends them to the client packed into bundles of up to mtu bytes.
+    """
+    def __init__(self, client, window=0.002, mtu=1472, scheduler=None):
+        self.client = client
+        self.window = window
+        self.mtu = mtu
+        self.scheduler = Scheduler() if scheduler is None else scheduler
+        self.lock = threading.Lock()
+        self.pending = []
+        self.size = len(_IMMEDIATE_BUNDLE)
+        self.batch = 0
+        self.messages = 0
+        self.packets = 0
+
+    def send(self, message):
+        data = serialize(message)
+        with self.lock:
+            self.messages += 1
+            if self.pending and self.size + 4 + len(data) > self.mtu:
+                self._flush()
+            self.pending.append(data)
+            self.size += 4 + len(data)
+            if len(self.pending) == 1:
+                self.scheduler.schedule(time.time() + self.window, self.flush, self.batch)
+
+    def flush(self, batch=None):
+        with self.lock:
+            if batch is None or batch == self.batch:
+                self._flush()
+
+    def _flush(self):
+        if len(self.pending) == 1:
+            self.client.send_raw(self.pending[0])
+        elif self.pending:
+            self.client.send_raw(_IMMEDIATE_BUNDLE + "".join([_pack_int(len(data)) + data for data in self.pending]))
+        else:
+            return
+        self.packets += 1
+        self.pending = []
+        self.size = len(_IMMEDIATE_BUNDLE)
+        self.batch += 1
+
+    def stats(self):
+        return {"messages": self.messages,
+                "packets": self.packets,
+                "reduction": 1.0 - float(self.packets) / self.messages if self.messages else 0.0}
+
+
+class BufferPool(object):
+    def __init__(self, size, count=16):
+        self.size = size
+        self.count = count
+        self.buffers = []
+
+    def acquire(self):
+        try:
+            return self.buffers.pop()
+        except IndexError:
+            return bytearray(self.size)
+
+    def release(self, buffer):
+        if len(self.buffers) < self.count:
+            self.buffers.append(buffer)
+
+
+class PooledUDPServerMixIn:
+    """Receives datagrams into pooled buffers instead of allocating a string per packet."""
+    pool_size = 16
+    pool = None
+
+    def get_request(self):
+        buffer = self.pool.acquire()
+        try:
+            length, client_address = self.socket.recvfrom_into(buffer)
+        except:
+            self.pool.release(buffer)
+            raise
+        return (buffer, length, self.socket), client_address
+
+
+def _pooled(serverclass):
+    if issubclass(serverclass, PooledUDPServerMixIn):
+        return serverclass
+
+    class PooledServer(PooledUDPServerMixIn, serverclass):
+        def __init__(self, *args, **kwargs):
+            serverclass.__init__(self, *args, **kwargs)
+            self.pool = BufferPool(self.max_packet_size, self.pool_size)
+
+    PooledServer.__name__ = "Pooled" + serverclass.__name__
+    return PooledServer
+
+
+class EventLoopUDPServer(PooledUDPServerMixIn, SocketServer.UDPServer):
+    """
+    Handles every datagram on the serving thread, in arrival order.
+    All datagrams pending on the socket are drained on each wakeup of the select loop.
+    """
+    pool_size = 1
+    receive_buffer_size = 1 << 20
+
+    def __init__(self, server_address, RequestHandlerClass, bind_and_activate=True):
+        SocketServer.UDPServer.__init__(self, server_address, RequestHandlerClass, bind_and_activate)
+        self.pool = BufferPool(self.max_packet_size, self.pool_size)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.receive_buffer_size)
+        self.socket.setblocking(False)
+        self.running = False
+        self.stopped = threading.Event()
+
+    def serve_forever(self, poll_interval=0.5):
+        self.running = True
+        self.stopped.clear()
+        try:
+            while self.running:
+                # Like SocketServer, a select interrupted by a signal is retried
+                try:
+                    readable, writable, exceptional = select.select([self], [], [], poll_interval)
+                except select.error as e:
+                    if e.args[0] != errno.EINTR:
+                        raise
+                    continue
+                if readable:
+                    self.drain()
+        finally:
+            self.stopped.set()
+
+    def shutdown(self):
+        self.running = False
+        self.stopped.wait()
+
+    def drain(self):
+        while True:
+            try:
+                request, client_address = self.get_request()
+            except socket.error as e:
+                if e.errno == errno.EINTR:
+                    continue
+                # Nothing left to read, or an error which, like SocketServer, only ends this wakeup
+                return
+            try:
+                self.process_request(request, client_address)
+            except:
+                self.handle_error(request, client_address)
+                self.shutdown_request(request)
+
+
+class Scheduler(object):
+    """
+    Dispatches calls at given times from a single thread, ordered by a heap.
+    The lateness of every dispatch is recorded and optionally reported to on_dispatch(when, late).
+    """
+    def __init__(self, on_dispatch=None):
+        self.on_dispatch = on_dispatch
+        self.queue = []
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.thread = None
+        self.dispatched = 0
+        self.total_late = 0.0
+        self.max_late = 0.0
+        self.last_late = 0.0
+
+    def schedule(self, when, func, *args):
+        with self.condition:
+            heapq.heappush(self.queue, (when, next(self.sequence), func, args))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run)
+                self.thread.daemon = True
+                self.thread.start()
+            self.condition.notify()
+
+    def pending(self):
+        return len(self.queue)
+
+    def stats(self):
+        return {"pending": len(self.queue),
+                "dispatched": self.dispatched,
+                "last_late": self.last_late,
+                "max_late": self.max_late,
+                "mean_late": self.total_late / self.dispatched if self.dispatched else 0.0}
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.queue:
+                    self.condition.wait()
+                diff = self.queue[0][0] - time.time()
                 if diff > 0:
-                    time.sleep(diff)
-                for subelement in element.elements:
-                    self.handle_element(subelement)
+                    self.condition.wait(diff)
+                    continue
+                when, sequence, func, args = heapq.heappop(self.queue)
+            self._dispatch(when, func, args)
+
+    def _dispatch(self, when, func, args):
+        late = max(time.time() - when, 0.0)
+        self.dispatched += 1
+        self.total_late += late
+        self.last_late = late
+        self.max_late = max(self.max_late, late)
+        if self.on_dispatch is not None:
+            self.on_dispatch(when, late)
+        try:
+            func(*args)
+        except Exception:
+            traceback.print_exc()
 
-        self.server = serverclass(address, Unbundler)
+
+class Server(object):
+    def __init__(self, address, handler, serverclass = SocketServer.ThreadingUDPServer, scheduler=None):
+        server = self
+
+        class Unbundler(SocketServer.BaseRequestHandler):
+            def handle(self):
+                received = time.time()
+                buffer, length, sock = self.request
+                stream = DeserializerStream(buffer, length, lazy=True)
+                try:
+                    server.handle_element(stream.read(), self.client_address, received)
+                finally:
+                    stream.detach()
+                    self.server.pool.release(buffer)
+
+        self.server = _pooled(serverclass)(address, Unbundler)
         self.handler = handler
+        self.scheduler = Scheduler() if scheduler is None else scheduler
+
+    def handle_element(self, element, client_address, received=None, timetag=None):
+        if isinstance(element, Message):
+            element.received = received
+            element.timetag = timetag
+            self.handler(element, client_address)
+            return
+        if element.timetag > time.time():
+            self.scheduler.schedule(element.timetag, self.handle_bundle, element, client_address, received)
+            return
+        self.handle_bundle(element, client_address, received)
+
+    def handle_bundle(self, bundle, client_address, received=None):
+        # Bundles timed before their reception, such as "immediately", are not timed
+        timetag = bundle.timetag if received is not None and bundle.timetag > received else None
+        for element in bundle.elements:
+            self.handle_element(element, client_address, received, timetag)
 
     def handle(self, message, client_address):
-        # TODO: Handle patterns
-        pattern = message.address
         self.handler(message, client_address)
 
     def serve_forever(self):
@@ -222,6 +824,118 @@ def test():
     message = Bundle(Time(123), Message("/abcd/defg/", 1, 2.0, "3", Time(4.5), Blob("67")))
     assert serialize(message) == serialized
     assert deserialize(serialized) == message
+    # Second pass goes through the cached codecs
+    assert serialize(message) == serialized
+    assert deserialize(serialized) == message
+    fader = Message("/1/fader1", 0.5, 3, None, Time(4.5))
+    assert deserialize(serialize(fader)) == fader
+
+    buffer = bytearray(serialized + "garbage from a previous packet")
+    stream = DeserializerStream(buffer, len(serialized), lazy=True)
+    lazy = stream.read()
+    stream.detach()
+    buffer[:] = "\x00" * len(buffer)
+    assert lazy == message
+
+    # A truncated packet in a reused buffer fails like the same bytes as a string instead of reading older bytes
+    previous = serialize(Message("/1/fader1", 0.75))
+    truncated = previous[:-4]
+    for packet in (truncated, bytearray(previous)):
+        try:
+            DeserializerStream(packet, len(truncated)).read()
+            assert False
+        except struct.error:
+            pass
+    blob = serialize(Message("/blob", Blob("abcdefgh")))
+    try:
+        DeserializerStream(bytearray(blob), len(blob) - 4).read()
+        assert False
+    except struct.error:
+        pass
+
+    # Arguments read by another thread while the buffer is released are never decoded from a reused buffer
+    buffer = bytearray(serialize(fader))
+    stream = DeserializerStream(buffer, lazy=True)
+    lazies = [stream.read()]
+    reader = threading.Thread(target=lambda: lazies.append(lazies[0].args))
+    reader.start()
+    stream.detach()
+    buffer[:] = "\x00" * len(buffer)
+    reader.join()
+    assert lazies[1] == fader.args
+
+    dispatched = []
+    done = threading.Event()
+    scheduler = Scheduler()
+    now = time.time()
+    for delay in (0.03, 0.01, 0.02):
+        scheduler.schedule(now + delay, dispatched.append, delay)
+    scheduler.schedule(now + 0.04, done.set)
+    assert done.wait(1)
+    assert dispatched == [0.01, 0.02, 0.03]
+    assert scheduler.stats()["dispatched"] == 4
+
+    class Collector(object):
+        def __init__(self):
+            self.packets = []
+            self.scheduled = []
+
+        def send_raw(self, data):
+            self.packets.append(data)
+
+        def schedule(self, when, func, *args):
+            self.scheduled.append((func, args))
+
+    collector = Collector()
+    batching = BatchingClient(collector, window=10, mtu=64, scheduler=collector)
+    for i in xrange(6):
+        batching.send(Message("/1/fader1", float(i)))
+    batching.flush()
+    packets = [deserialize(packet) for packet in collector.packets]
+    assert [len(packet.elements) for packet in packets] == [2, 2, 2]
+    assert [element.args[0] for packet in packets for element in packet.elements] == range(6)
+    assert batching.stats()["packets"] == 3
+
+    routes = AddressMap((address, address) for address in ["/1/fader1", "/1/fader2", "/1/fader10", "/2/fader1",
+                                                         "/mixer/a/vol", "/mixer/b/vol", "/mixer/c/vol"])
+    assert routes.match("/1/fader1") == ["/1/fader1"]
+    assert routes.match("/1/fader?") == ["/1/fader1", "/1/fader2"]
+    assert routes.match("/*/fader1") == ["/1/fader1", "/2/fader1"]
+    assert routes.match("/1/fader[!2]*") == ["/1/fader1", "/1/fader10"]
+    assert routes.match("/mixer/{a,c}/vol") == ["/mixer/a/vol", "/mixer/c/vol"]
+    assert routes.match("/mixer/[a-b]/vol") == ["/mixer/a/vol", "/mixer/b/vol"]
+    assert routes.match("/3/*") == []
+    routes["/3/fader1"] = "/3/fader1"
+    assert routes.match("/3/*") == ["/3/fader1"]
+    for i in xrange(AddressMap.cache_size + 10):
+        routes.match("/%d*/fader1" % i)
+    assert len(AddressMap._segments) <= AddressMap.cache_size
+    assert len(routes.resolved) <= AddressMap.cache_size
+    assert routes.match("/*/fader1") == ["/1/fader1", "/2/fader1", "/3/fader1"]
+
+    clients = MultiClient(limit=3, timeout=10)
+    receivers = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for i in xrange(3)]
+    for receiver in receivers:
+        receiver.bind(("127.0.0.1", 0))
+        receiver.settimeout(1)
+    assert clients.add(receivers[0].getsockname())
+    now = time.time()
+    assert clients.add(receivers[1].getsockname(), now)
+    assert clients.add(receivers[2].getsockname(), now + 5)
+    assert not clients.add(("127.0.0.1", 1), now + 5)
+    clients.send(fader)
+    assert [deserialize(receiver.recv(1024)) for receiver in receivers] == [fader] * 3
+    assert clients.expire(now + 12) == [receivers[1].getsockname()]
+    assert clients.next_expiry == now + 15
+    assert receivers[2].getsockname() in clients.addresses
+    assert clients.add(receivers[2].getsockname(), now + 14)
+    assert clients.expire(now + 16) == []
+    assert clients.stats() == {"clients": 2, "packets": 1, "datagrams": 3, "errors": 0}
+    clients.add(("host.invalid", 1))
+    clients.add(receivers[2].getsockname())
+    clients.send(fader)
+    assert deserialize(receivers[2].recv(1024)) == fader
+    assert clients.stats()["errors"] == 1
     
 if __name__ == "__main__":
     test()
\ No newline at end of file
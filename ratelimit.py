@@ -0,0 +1,89 @@
+"""
+Copyright (c) 2013 by Tomer Altman <tomer.altman@gmail.com>
+
+This file is part of MOSC.
+
+MOSC is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+MOSC is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with MOSC.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import threading
+import time
+
+
+def interval(rate):
+    # Seconds between the values sent at rate per second, None when rate is None
+    if rate is None:
+        return None
+    if not isinstance(rate, (int, float)) or rate <= 0:
+        raise Exception("Invalid rate limit %r, expected a positive number of updates per second or null" % (rate, ))
+    return 1.0 / rate
+
+
+class RateLimiter(object):
+    """
+    Limits the values sent to each address to a rate per second.
+    A value arriving too early replaces the value waiting for the address, which the scheduler sends
+    when the address's interval ends, so the last value always goes out.
+    """
+    def __init__(self, send, scheduler, rate=None, on_flush=None):
+        self.send = send
+        self.on_flush = on_flush
+        self.scheduler = scheduler
+        self.interval = interval(rate)
+        self.intervals = {}
+        self.next_times = {}
+        self.pending = {}
+        self.deferred = {}
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.coalesced = 0
+
+    def set_rate(self, address, rate):
+        self.intervals[address] = interval(rate)
+
+    def __call__(self, address, *value):
+        interval = self.intervals.get(address, self.interval)
+        if interval is None:
+            self.send(address, *value)
+            return
+
+        now = time.time()
+        with self.lock:
+            if address in self.pending:
+                self.pending[address] = value
+                self.coalesced += 1
+                return
+            next_time = self.next_times.get(address, 0.0)
+            if now < next_time:
+                self.pending[address] = value
+                self.deferred[address] = now
+                self.scheduler.schedule(next_time, self._flush, address, interval)
+                return
+            self.next_times[address] = now + interval
+            self.sent += 1
+        self.send(address, *value)
+
+    def _flush(self, address, interval):
+        with self.lock:
+            value = self.pending.pop(address)
+            now = time.time()
+            deferred = self.deferred.pop(address)
+            self.next_times[address] = now + interval
+            self.sent += 1
+        if self.on_flush is not None:
+            self.on_flush(address, now - deferred)
+        self.send(address, *value)
+
+    def stats(self):
+        return {"sent": self.sent, "coalesced": self.coalesced, "pending": len(self.pending)}
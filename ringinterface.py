@@ -0,0 +1,182 @@
+"""
+Copyright (c) 2013 by Tomer Altman <tomer.altman@gmail.com>
+
+This file is part of MOSC.
+
+MOSC is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+MOSC is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with MOSC.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import struct
+import marshal
+import threading
+import traceback
+import multiprocessing
+
+import interface
+import oscinterface
+import pysc
+
+# Record header: address id (INLINE when the address is in the payload), payload length, reception time, target time
+RECORD = struct.Struct("<HIdd")
+INLINE = 0xFFFF
+
+
+class Ring(object):
+    """
+    Single producer, single consumer ring of records in shared memory, passing events between two processes.
+    The producer only moves the head and the consumer only the tail, each after copying a whole record,
+    so no lock is needed. Positions run over twice the size to tell a full ring from an empty one.
+    The count of dropped records is kept in shared memory along the positions, so both processes see it.
+    A consumer finding the ring empty waits on a semaphore, released by the producer when it fills an empty ring.
+    """
+    def __init__(self, size=1 << 20):
+        self.size = size
+        self.buffer = multiprocessing.RawArray("c", size)
+        # Head, tail and dropped records
+        self.positions = multiprocessing.RawArray("L", 3)
+        self.ready = multiprocessing.Semaphore(0)
+
+    @property
+    def dropped(self):
+        return self.positions[2]
+
+    def used(self):
+        return (self.positions[0] - self.positions[1]) % (2 * self.size)
+
+    def put(self, data):
+        length = len(data)
+        if self.used() + length > self.size:
+            # The consumer is not keeping up, the event is lost rather than blocking the producer
+            self.positions[2] += 1
+            return False
+        head = self.positions[0]
+        start = head % self.size
+        first = min(length, self.size - start)
+        self.buffer[start:start + first] = data[:first]
+        if first < length:
+            self.buffer[0:length - first] = data[first:]
+        self.positions[0] = (head + length) % (2 * self.size)
+        # Only the record just put is in the ring: the consumer may be waiting for it
+        if self.used() <= length:
+            self.ready.release()
+        return True
+
+    def wait(self):
+        self.ready.acquire()
+
+    def get(self):
+        used = self.used()
+        if not used:
+            return ""
+        tail = self.positions[1]
+        start = tail % self.size
+        first = min(used, self.size - start)
+        data = self.buffer[start:start + first]
+        if first < used:
+            data += self.buffer[0:used - first]
+        self.positions[1] = (tail + used) % (2 * self.size)
+        return data
+
+
+class RingEndpoint(object):
+    """
+    Encodes events to one ring and decodes the events of another, calling handler(address, *values) for each.
+    Addresses known to both processes are sent as their index in addresses, others in full.
+    """
+    def __init__(self, send_ring, receive_ring, addresses):
+        self.send_ring = send_ring
+        self.receive_ring = receive_ring
+        self.addresses = list(addresses)
+        if len(self.addresses) >= INLINE:
+            raise Exception("Too many addresses to pass between processes: %d, at most %d" % (len(self.addresses), INLINE - 1))
+        self.ids = dict((address, i) for i, address in enumerate(self.addresses))
+        self.lock = threading.Lock()
+
+    def put(self, address, values, received=None, target=None):
+        values = tuple(pysc.plain(value) for value in values)
+        id = self.ids.get(address, INLINE)
+        payload = marshal.dumps(values if id != INLINE else (address, values))
+        record = RECORD.pack(id, len(payload), received or 0.0, target or 0.0) + payload
+        # Several threads may send, the ring only takes one producer at a time
+        with self.lock:
+            return self.send_ring.put(record)
+
+    def pump(self, handler):
+        while True:
+            data = self.receive_ring.get()
+            if not data:
+                self.receive_ring.wait()
+                continue
+            # Records are put whole, so the data never ends in the middle of one
+            offset = 0
+            while offset < len(data):
+                id, length, received, target = RECORD.unpack_from(data, offset)
+                end = offset + RECORD.size + length
+                values = marshal.loads(data[offset + RECORD.size:end])
+                if id == INLINE:
+                    address, values = values
+                else:
+                    address = self.addresses[id]
+                # A failing message must not stop the messages after it
+                try:
+                    handler(address, values, received or None, target or None)
+                except Exception:
+                    traceback.print_exc()
+                offset = end
+
+
+class RingInterface(interface.Interface):
+    """
+    Stands in for an OSC interface running in another process, started by start().
+    The other process receives and decodes the OSC messages, and encodes and sends the messages given to send.
+    """
+    def __init__(self, params, addresses, ring_size=1 << 20):
+        super(RingInterface, self).__init__()
+        self.params = params
+        self.to_osc = Ring(ring_size)
+        self.from_osc = Ring(ring_size)
+        self.endpoint = RingEndpoint(self.to_osc, self.from_osc, addresses)
+        self.process = multiprocessing.Process(target=serve_osc, args=(params, self.from_osc, self.to_osc, addresses))
+        self.process.daemon = True
+
+    def start(self):
+        self.process.start()
+        super(RingInterface, self).start()
+
+    def send(self, address, *value):
+        self.endpoint.put(address, value)
+
+    def dropped(self):
+        return {"to_osc": self.to_osc.dropped, "from_osc": self.from_osc.dropped}
+
+    def _run(self):
+        self.endpoint.pump(self._receive)
+
+    def _receive(self, address, values, received, target):
+        if self.handler is None:
+            return
+        interface.context.received = received
+        interface.context.target = target
+        self.handler(address, *values)
+
+
+def serve_osc(params, send_ring, receive_ring, addresses):
+    # Main function of the OSC process
+    import mosc
+    osc = mosc.create_interface(oscinterface.OSCInterface, params)
+    endpoint = RingEndpoint(send_ring, receive_ring, addresses)
+    osc.handler = lambda address, *value: endpoint.put(address, value, interface.context.received, interface.context.target)
+    osc.start()
+    endpoint.pump(lambda address, values, received, target: osc.send(address, *values))
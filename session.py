@@ -0,0 +1,176 @@
+"""
+Copyright (c) 2013 by Tomer Altman <tomer.altman@gmail.com>
+
+This file is part of MOSC.
+
+MOSC is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+MOSC is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with MOSC.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import sys
+import time
+import struct
+import marshal
+import argparse
+import threading
+import collections
+import timeit
+
+import interface
+import pysc
+import mosc
+
+"""
+Session log format:
+"MOSCLOG2", followed by records of
+    timestamp (double, seconds), source (byte, 0 for osc, 1 for midi), kind (byte, 0 for input, 1 for output),
+    payload length (unsigned int), payload (marshal of (address, values)).
+"""
+
+MAGIC = "MOSCLOG2"
+RECORD = struct.Struct("<dBBI")
+SOURCES = "osc", "midi"
+INPUT, OUTPUT = 0, 1
+
+
+class Recorder(object):
+    """
+    Records the messages passing through the handlers and sends of interfaces into a session log.
+    Recording only appends to a queue, the records are packed and written by the recorder's thread.
+    """
+    def __init__(self, path, period=0.05):
+        self.file = open(path, "wb")
+        self.file.write(MAGIC)
+        self.events = collections.deque()
+        self.clock = timeit.default_timer
+        self.period = period
+        self.running = True
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def attach(self, app):
+        self.attach_interface(SOURCES.index("osc"), app.osc.interface)
+        self.attach_interface(SOURCES.index("midi"), app.midi.interface)
+
+    def attach_interface(self, source, recorded):
+        handler, send = recorded.handler, recorded.send
+        append, clock = self.events.append, self.clock
+
+        def record_handler(address, *value):
+            append((clock(), source, INPUT, address, value))
+            handler(address, *value)
+
+        def record_send(address, *value):
+            append((clock(), source, OUTPUT, address, value))
+            send(address, *value)
+
+        recorded.handler = record_handler
+        recorded.send = record_send
+
+    def _run(self):
+        while self.running:
+            time.sleep(self.period)
+            self._write()
+
+    def _write(self):
+        records = []
+        while True:
+            try:
+                timestamp, source, kind, address, value = self.events.popleft()
+            except IndexError:
+                break
+            payload = marshal.dumps((address, tuple(pysc.plain(x) for x in value)))
+            records.append(RECORD.pack(timestamp, source, kind, len(payload)) + payload)
+        if records:
+            self.file.write("".join(records))
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+        self._write()
+        self.file.close()
+
+
+def read_log(path):
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise Exception("%s is not a MOSC session log" % path)
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            timestamp, source, kind, length = RECORD.unpack(header)
+            address, value = marshal.loads(f.read(length))
+            yield timestamp, source, kind, address, value
+
+
+class ReplayInterface(interface.Interface):
+    def __init__(self):
+        super(ReplayInterface, self).__init__()
+        self.sent = []
+
+    def send(self, address, *value):
+        self.sent.append((address, value))
+
+    def _run(self):
+        pass
+
+
+def replay(log, mapname, speed=1.0):
+    """
+    Feeds the inputs of a session log to a mapper built from the map, speed times faster than recorded,
+    or as fast as possible when speed is 0. Returns the throughput and how the outputs differ from the recorded ones.
+    """
+    records = list(read_log(log))
+    interfaces = ReplayInterface(), ReplayInterface()
+    app = mosc.ValueMapperApp(open(mapname), interfaces=dict(zip(SOURCES, interfaces)))
+    inputs = [record for record in records if record[2] == INPUT]
+    expected = collections.Counter((record[1], record[3], record[4]) for record in records if record[2] == OUTPUT)
+
+    handlers = [iface.handler for iface in interfaces]
+    first = inputs[0][0] if inputs else 0.0
+    start = time.time()
+    for timestamp, source, kind, address, value in inputs:
+        if speed:
+            delay = start + (timestamp - first) / speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        handlers[source](address, *value)
+    elapsed = time.time() - start
+
+    # Leave time for values held by rate limits to be sent
+    while app.scheduler.pending():
+        time.sleep(0.01)
+
+    produced = collections.Counter((source, address, value) for source, iface in enumerate(interfaces)
+                                   for address, value in iface.sent)
+    return {"inputs": len(inputs),
+            "elapsed": elapsed,
+            "throughput": len(inputs) / elapsed if elapsed else 0.0,
+            "outputs": sum(produced.values()),
+            "recorded_outputs": sum(expected.values()),
+            "missing": sum((expected - produced).values()),
+            "extra": sum((produced - expected).values())}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replays a session log recorded by mosc.py --record through a map")
+    parser.add_argument("log")
+    parser.add_argument("mapname")
+    parser.add_argument("-s", "--speed", type=float, default=1.0, help="Replay speed, 0 for as fast as possible")
+    args = parser.parse_args()
+    result = replay(args.log, args.mapname, args.speed)
+    print "Replayed %(inputs)d inputs in %(elapsed).3f seconds (%(throughput).0f/s)" % result
+    print "Outputs: %(outputs)d, recorded: %(recorded_outputs)d, missing: %(missing)d, extra: %(extra)d" % result
+    sys.exit(1 if result["missing"] or result["extra"] else 0)
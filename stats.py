@@ -0,0 +1,145 @@
+"""
+Copyright (c) 2013 by Tomer Altman <tomer.altman@gmail.com>
+
+This file is part of MOSC.
+
+MOSC is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+MOSC is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with MOSC.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import math
+import json
+import time
+import threading
+
+
+class Histogram(object):
+    """
+    Latency histogram with logarithmic buckets, each 10% wider than the previous, from 1 microsecond to over a minute.
+    """
+    MIN = 1e-6
+    GROWTH = 1.1
+    BUCKETS = 200
+
+    def __init__(self):
+        self.buckets = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        if seconds > self.MIN:
+            index = min(int(math.log(seconds / self.MIN, self.GROWTH)) + 1, self.BUCKETS - 1)
+        else:
+            index = 0
+        self.buckets[index] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, percent):
+        if not self.count:
+            return 0.0
+        rank = self.count * percent / 100.0
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank:
+                # Upper bound of the bucket
+                return min(self.MIN * self.GROWTH ** index, self.max)
+        return self.max
+
+    def summary(self):
+        return {"count": self.count,
+                "mean": self.total / self.count if self.count else 0.0,
+                "max": self.max,
+                "p50": self.percentile(50),
+                "p90": self.percentile(90),
+                "p99": self.percentile(99)}
+
+
+class RouteStats(object):
+    STAGES = "receive", "transform", "queue", "write", "total"
+
+    def __init__(self):
+        self.count = 0
+        self.stages = dict((stage, Histogram()) for stage in self.STAGES)
+        self.suppressed = {"unchanged": 0, "echo": 0}
+
+    def summary(self):
+        summary = dict((stage, histogram.summary()) for stage, histogram in self.stages.iteritems())
+        summary["count"] = self.count
+        summary["suppressed"] = dict(self.suppressed)
+        return summary
+
+
+class Stats(object):
+    """
+    Counters and latency histograms of the messages sent on each route, a route being a direction
+    ("osc->midi" or "midi->osc") and the address the message is sent to. The stages are:
+    receive: from the reception of the message by the source interface until the mapper handles it.
+    transform: from handling the message until its values are transformed and ready to be sent.
+    queue: time spent waiting in the rate limiter and in the output queue of the destination interface.
+    write: time spent writing the message to the destination interface.
+    total: from the reception of the message until it was written.
+    Values suppressed as unchanged, or as echoes of the values sent to the address, are counted apart.
+    The lateness of the elements of timed OSC bundles, dispatched by the scheduler, is kept in scheduled.
+    """
+    def __init__(self):
+        self.routes = {}
+        self.scheduled = Histogram()
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def route(self, direction, address):
+        route = self.routes.get((direction, address))
+        if route is None:
+            with self.lock:
+                route = self.routes.setdefault((direction, address), RouteStats())
+        return route
+
+    def snapshot(self, match=""):
+        now = time.time()
+        directions = {}
+        routes = {}
+        for (direction, address), route in self.routes.items():
+            directions[direction] = directions.get(direction, 0) + route.count
+            if match in str(address):
+                routes["%s %s" % (direction, address)] = route.summary()
+        uptime = now - self.started
+        return {"time": now,
+                "uptime": uptime,
+                "directions": dict((direction, {"count": count, "rate": count / uptime})
+                                   for direction, count in directions.iteritems()),
+                "scheduled": self.scheduled.summary(),
+                "routes": routes}
+
+    def dump(self, path):
+        temp = path + ".tmp"
+        with open(temp, "w") as f:
+            json.dump(self.snapshot(), f, indent=1, sort_keys=True)
+        # Replace in one step so readers never see a partial file
+        if os.name == "nt" and os.path.exists(path):
+            os.remove(path)
+        os.rename(temp, path)
+
+    def start_dump(self, path, period):
+        def run():
+            while True:
+                time.sleep(period)
+                self.dump(path)
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
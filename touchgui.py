@@ -2,10 +2,11 @@ from Tkinter import *
 import tkFileDialog
 import tkMessageBox
 import itertools
-import subprocess
 import traceback
 import pygame.midi as pym
 
+import touchmapper
+
 class Port(Frame):
     def __init__(self, parent, label, names):
         Frame.__init__(self, parent)
@@ -84,9 +85,12 @@ def create_mapping():
         remotepath = remote.entry.get()
         oscport = port_entry.get()
         cubasetomosc, mosctocubase = midi_frame.get_selected_port_names()
-        command = ["touchmapper.py", layoutpath, moscpath, remotepath, oscport, cubasetomosc, mosctocubase]
-        subprocess.check_call(command, shell=True)
-        tkMessageBox.showinfo("Success", "Finished successfully!")
+        update = touchmapper.convert(layoutpath, moscpath, remotepath, int(oscport), cubasetomosc, mosctocubase)
+        if update is not None:
+            tkMessageBox.showinfo("Success", "Finished successfully! %d bytes per full update (%d sequentially)" % (
+                update["allocated"], update["sequential"]))
+        else:
+            tkMessageBox.showinfo("Success", "The mapping is already up to date.")
     except:
         traceback.print_exc()
         tkMessageBox.showerror("Failure", "Error in operation")
@@ -18,8 +18,10 @@ along with MOSC.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import zipfile
-import sys
 import os
+import hashlib
+import argparse
+import multiprocessing
 import xml.etree.ElementTree as ET
 
 import yaml
@@ -46,26 +48,107 @@ mosc:
 cubase: note, code, (0, 127), RPT?N?
 """
 
+# Part of the content hash of the outputs, bumped whenever the outputs of a layout change
+VERSION = 2
+HASH_PREFIX = "# touchmapper "
+
+
+def iter_controls(stream):
+    """
+    Yields the controls of the tabpages of a layout while parsing it, discarding each one once handled
+    so that large layouts are never held in memory whole.
+    """
+    path = []
+    for event, element in ET.iterparse(stream, events=("start", "end")):
+        if event == "start":
+            if not path:
+                assert element.get("version") == "13"
+            path.append(element)
+            continue
+        path.pop()
+        if len(path) == 2 and path[1].tag == "tabpage" and element.tag == "control":
+            yield element
+            path[1].clear()
+
+
+def expand_multi(osc, name, control):
+    # TouchOSC addresses the parts of multi-controls from 1 (by column then row for grids) while names count from 0
+    if control.get("number_x") is not None:
+        for x in xrange(int(control.get("number_x"))):
+            for y in xrange(int(control.get("number_y"))):
+                yield "%s/%d/%d" % (osc, x + 1, y + 1), name.replace("<x>", str(x)).replace("<y>", str(y))
+    else:
+        for x in xrange(int(control.get("number"))):
+            yield "%s/%d" % (osc, x + 1), name.replace("<x>", str(x))
+
+
+class MidiAllocator(object):
+    """
+    Hands out Midi addresses: the cheapest type of message giving the resolution asked for, spread evenly
+    over the channels. Each type is used up on every channel before falling back to a costlier one.
+    """
+    # Bytes sent for an update, NRPNs selecting their parameter each time in a full update
+    COSTS = {"noteon": 3, "cc": 3, "pitchbend": 3, "nrpn": 12}
+    BITS = {"noteon": 7, "cc": 7, "pitchbend": 14, "nrpn": 14}
+    MAXES = {"noteon": 127, "cc": 127, "pitchbend": 16383, "nrpn": 16383}
+    # Controllers with a meaning of their own: data entry, parameter selection and channel mode messages
+    RESERVED_CCS = set([6, 38]) | set(xrange(96, 102)) | set(xrange(120, 128))
+    CODES = {"noteon": range(128),
+             "cc": [cc for cc in xrange(128) if cc not in RESERVED_CCS],
+             "pitchbend": [0],
+             "nrpn": range(16384)}
+    # In order of preference
+    BUTTON_TYPES = "noteon", "cc", "pitchbend", "nrpn"
+    CONTINUOUS_TYPES = "cc", "pitchbend", "nrpn"
+
+    def __init__(self, channels=16):
+        self.channels = channels
+        self.used = dict((type, 0) for type in self.CODES)
+        self.bytes = 0
+
+    def allocate(self, types, bits):
+        for type in types:
+            if self.BITS[type] < bits:
+                continue
+            index = self.used[type]
+            if index < len(self.CODES[type]) * self.channels:
+                self.used[type] += 1
+                self.bytes += self.COSTS[type]
+                return type, index % self.channels, self.CODES[type][index // self.channels]
+        raise Exception("No Midi address left for %d bits" % bits)
+
+
+def midi_part(address, value_range=None):
+    # The shortest form MOSC reads, the channel only when not 0
+    type, channel, code = address
+    if channel == 0 and value_range is None:
+        return code if type == "nrpn" else [code, type]
+    part = [code, type] + list(value_range or (0, MidiAllocator.MAXES[type]))
+    return part + [channel] if channel else part
+
+
 class LayoutMapper(object):
-    def __init__(self, tree, cubase_mapper):
-        self.tree = tree
+    # Bits of resolution of continuous controls without a resolution flag
+    DEFAULT_BITS = 14
+
+    def __init__(self, controls, cubase_mapper, allocator=None):
+        self.controls = controls
         self.moscmap = []
         self.cubase_mapper = cubase_mapper
+        self.allocator = MidiAllocator() if allocator is None else allocator
+        # Bytes of a full update with every continuous control on a NRPN and every button on a note, as before allocating
+        self.sequential_bytes = 0
 
-        self.last_nrpn = -1
-        self.last_note = -1
-
-    def _generatenrpn(self):
-        self.last_nrpn += 1
-        return self.last_nrpn
-
-    def _generatenote(self):
-        self.last_note += 1
-        return self.last_note
+    def _allocate(self, button, bits):
+        if button:
+            self.sequential_bytes += MidiAllocator.COSTS["noteon"]
+            return self.allocator.allocate(MidiAllocator.BUTTON_TYPES, bits or 1)
+        self.sequential_bytes += MidiAllocator.COSTS["nrpn"]
+        return self.allocator.allocate(MidiAllocator.CONTINUOUS_TYPES, bits or self.DEFAULT_BITS)
 
     def _parsename(self, name):
         if "|" not in name:
-            return name, 0, 0, None
+            return name, 0, 0, None, None
         
         name, flags = name.rsplit("|", 1)
 
@@ -83,35 +166,37 @@ class LayoutMapper(object):
         if "N" in flags:
             flagsval |= self.cubase_mapper.NO_AUTO
 
-        return name, flagsval, rel, (">" in flags)
+        # Bits of resolution needed, such as "7" for 128 steps
+        bits = "".join(c for c in flags if c.isdigit())
+
+        return name, flagsval, rel, (">" in flags), int(bits) if bits else None
 
     def handle_single_cont(self, osc, name, localoff):
-        nrpn = self._generatenrpn()
-        name, flagsval, rel, onewayvalue = self._parsename(name)
-        self.cubase_mapper.add_mapping(("nrpn", 0, nrpn), name, flagsval, relative=(rel != 0), echo=localoff)
-        self.moscmap.append([osc, nrpn])
+        name, flagsval, rel, onewayvalue, bits = self._parsename(name)
+        address = self._allocate(False, bits)
+        self.cubase_mapper.add_mapping(address, name, flagsval, relative=(rel != 0), echo=localoff)
+        self.moscmap.append([osc, midi_part(address)])
 
     def handle_single_button(self, osc, name, localoff):
-        note = self._generatenote()
-        name, flags, rel, onewayvalue = self._parsename(name)
-        self.cubase_mapper.add_mapping(("noteon", 0, note), name, flags, relative=(rel != 0), echo=localoff)
+        name, flags, rel, onewayvalue, bits = self._parsename(name)
+        address = self._allocate(True, bits)
+        self.cubase_mapper.add_mapping(address, name, flags, relative=(rel != 0), echo=localoff)
         if rel < 0:
-            self.moscmap.append([osc, [note, "noteon", 0, 1]])
+            self.moscmap.append([osc, midi_part(address, (0, 1))])
         elif onewayvalue:
-            self.moscmap.append([osc, [note, "noteon"], ">"])
+            self.moscmap.append([osc, midi_part(address), ">"])
         else:
-            self.moscmap.append([osc, [note, "noteon"]])
+            self.moscmap.append([osc, midi_part(address)])
 
     def handle_encoder(self, osc, name, localoff):
-        note = self._generatenote()
-        name, flags, rel, onewayvalue = self._parsename(name)
-        self.cubase_mapper.add_mapping(("noteon", 0, note), name, flags, relative=True, echo=localoff)
-        self.moscmap.append([osc, [note, "noteon", 1, 127]])
+        name, flags, rel, onewayvalue, bits = self._parsename(name)
+        address = self._allocate(True, bits)
+        self.cubase_mapper.add_mapping(address, name, flags, relative=True, echo=localoff)
+        self.moscmap.append([osc, midi_part(address, (1, 127))])
 
-    def handle_multi(self, osc, name, number, single, localoff):
-        for i in xrnage(number):
-            # TODO: Allow offset from x
-            single(osc + "/" + str(i), name.replace("<x>", str(i)), localoff)
+    def handle_multi(self, osc, name, control, single, localoff):
+        for single_osc, single_name in expand_multi(osc, name, control):
+            single(single_osc, single_name, localoff)
 
     def get_single_handler(self, name):
         if name in ["faderv", "faderh", "rotaryv", "rotaryh"]:
@@ -122,8 +207,7 @@ class LayoutMapper(object):
             return self.handle_encoder
 
     def generatemapping(self):
-        assert self.tree.get("version") == "13"
-        for control in self.tree.findall("tabpage/control"):
+        for control in self.controls:
             name = control.get("name").decode("base64")
             if ";" not in name:
                 continue
@@ -144,26 +228,93 @@ class LayoutMapper(object):
                 continue
 
             if type.startswith("multi"):
-                self.handle_multi(cs_osc, name, control.get("number"), self.get_single_handler(type[5:]), localoff)
+                self.handle_multi(osc_cs, name, control, self.get_single_handler(type[5:]), localoff)
                 continue
             self.get_single_handler(type)(osc_cs, name, localoff)
 
 
-if __name__ == "__main__":
-    # TODO: More usable configuration. GUI?
-    layoutpath, moscpath, remotepath, oscport, cubasetomosc, mosctocubase = sys.argv[1:]
-    
-    zf = zipfile.ZipFile(layoutpath)
-    for name in zf.namelist():
-        if os.path.basename(name) == "index.xml":
-            tree = ET.fromstring(zf.read(name))
-            break
-    
-    cm = cubasemapper.CubaseMapper()
-    lm = LayoutMapper(tree, cm)
-    lm.generatemapping()
+def layout_hash(layoutpath, *params):
+    digest = hashlib.sha1(repr((VERSION, params)))
+    with open(layoutpath, "rb") as f:
+        for block in iter(lambda: f.read(1 << 16), ""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def is_current(moscpath, remotepath, digest):
+    # The hash of the layout the outputs were made from is the first line of the MOSC map
+    if not os.path.exists(remotepath) or not os.path.exists(moscpath):
+        return False
+    with open(moscpath) as f:
+        return f.readline().strip() == HASH_PREFIX + digest
+
+
+def convert(layoutpath, moscpath, remotepath, oscport=10000, cubasetomosc=None, mosctocubase=None, cache=True):
+    """
+    Writes the MOSC map and Cubase generic remote of a layout. Returns the bytes sent for updating every control
+    once, with sequential NRPNs and notes and as allocated, or None when the outputs are already up to date.
+    """
+    digest = layout_hash(layoutpath, oscport, cubasetomosc, mosctocubase)
+    if cache and is_current(moscpath, remotepath, digest):
+        return None
+
+    with zipfile.ZipFile(layoutpath) as zf:
+        for name in zf.namelist():
+            if os.path.basename(name) == "index.xml":
+                break
+        else:
+            raise Exception("%s has no index.xml" % layoutpath)
+        with open(remotepath, "w") as remote:
+            cm = cubasemapper.CubaseMapper(remote)
+            lm = LayoutMapper(iter_controls(zf.open(name)), cm)
+            lm.generatemapping()
+            cm.close()
+
     mosc_config = {"interfaces": {"osc": [int(oscport)], "midi": [cubasetomosc, mosctocubase]},
                    "mapping": lm.moscmap}
-    yaml.dump(mosc_config, open(moscpath, "w"))
-    open(remotepath, "w").write(cm.dump())
-    
\ No newline at end of file
+    # Written last, so that an interrupted conversion is never taken for a current one
+    with open(moscpath, "w") as f:
+        f.write(HASH_PREFIX + digest + "\n")
+        yaml.dump(mosc_config, f, Dumper=getattr(yaml, "CDumper", yaml.Dumper))
+    return {"sequential": lm.sequential_bytes, "allocated": lm.allocator.bytes}
+
+
+def _convert(args):
+    return convert(*args)
+
+
+def convert_many(jobs, processes=None):
+    """Converts the layouts of jobs, tuples of convert's arguments, across a pool of processes."""
+    if len(jobs) == 1 or processes == 1:
+        return map(_convert, jobs)
+    pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(_convert, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maps TouchOSC layouts to MOSC maps and Cubase generic remotes")
+    parser.add_argument("layouts", nargs="+", help="TouchOSC layouts (.touchosc)")
+    parser.add_argument("-o", "--output", help="Directory of the outputs, named after each layout (by default next to the layout)")
+    parser.add_argument("--port", type=int, default=10000, help="OSC port of the MOSC maps")
+    parser.add_argument("--midi", nargs=2, metavar=("CUBASE_TO_MOSC", "MOSC_TO_CUBASE"), default=[None, None],
+                        help="Midi interfaces of the MOSC maps")
+    parser.add_argument("-j", "--processes", type=int, help="Number of layouts converted at once (by default, the number of CPUs)")
+    parser.add_argument("--force", action="store_true", help="Convert even the layouts whose outputs are up to date")
+    args = parser.parse_args()
+
+    jobs = []
+    for layoutpath in args.layouts:
+        base = os.path.splitext(layoutpath)[0]
+        if args.output:
+            base = os.path.join(args.output, os.path.basename(base))
+        jobs.append((layoutpath, base + ".txt", base + ".xml", args.port, args.midi[0], args.midi[1], not args.force))
+    for (layoutpath, moscpath, remotepath, _, _, _, _), update in zip(jobs, convert_many(jobs, args.processes)):
+        if update is None:
+            print "%s: up to date" % layoutpath
+        else:
+            print "%s: %s, %s (%d bytes per full update, %d sequentially)" % (
+                layoutpath, moscpath, remotepath, update["allocated"], update["sequential"])
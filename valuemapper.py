@@ -18,7 +18,7 @@ along with MOSC.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 class ValueMapper(object):
-    def __init__(self, interfaces, mapping, transformers):
+    def __init__(self, interfaces, mapping, transformers, monitor=None):
         self.interfaces = interfaces
         for i, interface in enumerate(interfaces):
             interface.handler = self._gethandler(i)
@@ -28,7 +28,8 @@ class ValueMapper(object):
             self.mappings.append(dict((mapparts[i].address, mapparts) for mapparts in mapping if mapparts[i] is not None))
 
         self.transformers = transformers
-        self.last_address = None
+        self.monitor = monitor
+        self.sources = [("%d in" % i, "%d out" % i) for i in xrange(len(interfaces))]
 
     def _gethandler(self, interfaceid):
         def handle(address, value):
@@ -36,13 +37,8 @@ class ValueMapper(object):
         return handle
 
     def _handle(self, address, value, interfaceid):
-        if address != self.last_address:
-            self.last_address = address
-            print
-            print "%s:" % (address, )
-
-        print "\r" + 100 * " " + "\r",
-        print value,
+        if self.monitor is not None:
+            self.monitor.record(self.sources[interfaceid][0], address, (value, ))
 
         if address not in self.mappings[interfaceid]:
             return
@@ -54,5 +50,6 @@ class ValueMapper(object):
                 continue
 
             value = self.transformers[interfaceid][i](param_in, mappart.param, value)
-            print "-> %s: %s" % (mappart.address, value),
+            if self.monitor is not None:
+                self.monitor.record(self.sources[i][1], mappart.address, (value, ))
             self.interfaces[i].send(mappart.address, value)